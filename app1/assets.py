@@ -0,0 +1,125 @@
+# Web asset manifest.
+#
+# Built once at startup and kept current by a debounced mtime poll in a
+# worker thread, so a client (re)connecting gets the content hash from
+# memory instead of each one walking and stat()ing the web folder on the
+# event loop.  Per-file content hashes are kept for cache validation.
+#
+# Text assets are also kept in memory precompressed (gzip, and brotli if
+# the module is installed) so they can be served by Accept-Encoding from
+# the content-addressed /v/<hash>/ URLs without compressing per request.
+
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import stat
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+POLL = 2.0      # seconds between mtime scans
+SETTLE = 0.5    # edits must be stable this long before we rehash
+
+# Worth compressing; images and woff2 fonts already are.
+COMPRESS = {'.html', '.js', '.mjs', '.css', '.json', '.svg', '.ico', '.txt', '.map'}
+
+
+def md5_file(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 16):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Returns {encoding: bytes}, keeping only variants that actually save space.
+def compress(data):
+    variants = {'identity': data}
+    if brotli:
+        variants['br'] = brotli.compress(data, quality=11)
+    variants['gzip'] = gzip.compress(data, 9, mtime=0)
+    return {k: v for (k, v) in variants.items()
+        if k == 'identity' or len(v) < len(data) * 0.9}
+
+
+class Manifest:
+    def __init__(self, root):
+        self.root = root
+        self.log = logging.getLogger('assets')
+        self.stats = {}     # relative path: (mtime_ns, size)
+        self.files = {}     # relative path: md5 hex of contents
+        self.blobs = {}     # relative path: {encoding: bytes}, compressible files only
+        self.hash = None    # over all paths and their content hashes
+        self.listeners = []
+
+
+    # Cheap pass: stat everything, read nothing.
+    def scan(self):
+        stats = {}
+        for (dirpath, _dirs, names) in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                if stat.S_ISREG(st.st_mode):
+                    rel = os.path.relpath(path, self.root).replace(os.sep, '/')
+                    stats[rel] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+
+    # Rehash (and recompress) only files whose mtime or size changed.
+    def update(self, stats):
+        files = {}
+        blobs = {}
+        for (rel, st) in stats.items():
+            if self.stats.get(rel) == st and rel in self.files:
+                files[rel] = self.files[rel]
+                if rel in self.blobs:
+                    blobs[rel] = self.blobs[rel]
+            elif os.path.splitext(rel)[1] in COMPRESS:
+                data = (self.root / rel).read_bytes()
+                files[rel] = hashlib.md5(data).hexdigest()
+                blobs[rel] = compress(data)
+            else:
+                files[rel] = md5_file(self.root / rel)
+
+        h = hashlib.md5()
+        for rel in sorted(files):
+            h.update(f'{rel}:{files[rel]}\n'.encode())
+
+        self.stats, self.files, self.blobs, self.hash = stats, files, blobs, h.hexdigest()
+
+
+    def build(self):
+        self.update(self.scan())
+        raw = sum(len(v['identity']) for v in self.blobs.values())
+        best = sum(min(map(len, v.values())) for v in self.blobs.values())
+        self.log.info('%d web assets, hash %s, %d compressed %d -> %d bytes%s',
+            len(self.files), self.hash, len(self.blobs), raw, best,
+            '' if brotli else ' (no brotli)')
+
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(POLL)
+            stats = await asyncio.to_thread(self.scan)
+            if stats == self.stats:
+                continue
+
+            # debounce: an editor or rsync may still be writing
+            await asyncio.sleep(SETTLE)
+            if stats != await asyncio.to_thread(self.scan):
+                continue    # still changing, catch it next poll
+
+            old = self.hash
+            await asyncio.to_thread(self.update, stats)
+            if self.hash != old:
+                self.log.info('web assets changed, hash %s', self.hash)
+                for func in self.listeners:
+                    func(self)
+
+
+# EOF
@@ -0,0 +1,126 @@
+# Lens calibration.
+#
+# Intrinsics and distortion come from DIR/cam<N>-<W>x<H>.json (--calib):
+#
+#   {"camera_matrix": [[fx, 0, cx], [0, fy, cy], [0, 0, 1]],
+#    "dist_coeffs": [k1, k2, p1, p2, k3]}
+#
+# as from cv2.calibrateCamera().  A file for another resolution with the
+# same aspect ratio is scaled to fit.  Without one we fall back to the old
+# fixed 660 px focal length and no distortion.
+#
+# Frames are never undistorted: only the points we report (tag corners
+# and centres, ring box), by looking them up in a table of where each
+# pixel really belongs.  The table is built once per calibration and size
+# and cached in DIR/.cache, since it takes a while on a Pi.  Remapping the
+# whole image is only for viewers who ask for it (stream1.mjpeg?undistort=1).
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+FOCAL = 660     # px, when there's no calibration
+
+log = logging.getLogger('calib')
+
+
+class Calibration:
+    def __init__(self, size, K, dist, path=None):
+        self.size = tuple(size)
+        self.K = np.asarray(K, np.float64).reshape(3, 3)
+        self.dist = np.asarray(dist, np.float64).ravel()
+        self.path = path    # calibration dir, for the cache
+        self.table = None
+        self._maps = None
+
+    @property
+    def identity(self):
+        return not self.dist.any()
+
+    def key(self):
+        h = hashlib.sha1(np.array(self.size, np.int32).tobytes())
+        h.update(self.K.tobytes())
+        h.update(self.dist.tobytes())
+        return h.hexdigest()[:16]
+
+    # Build or load the undistortion table: (H, W, 2) float32 of the
+    # undistorted position of each pixel centre, in the same K.
+    def prepare(self):
+        if self.identity or self.table is not None:
+            return self
+        cache = self.path / '.cache' / f'undistort-{self.key()}.npy' if self.path else None
+        if cache and cache.exists():
+            self.table = np.load(cache)
+            return self
+
+        (w, h) = self.size
+        grid = np.mgrid[0:h, 0:w][::-1].transpose(1, 2, 0).reshape(-1, 1, 2).astype(np.float32)
+        pts = cv2.undistortPoints(grid, self.K, self.dist, P=self.K)
+        self.table = pts.reshape(h, w, 2)
+        if cache:
+            cache.parent.mkdir(exist_ok=True)
+            np.save(cache, self.table)
+            log.info('cached %dx%d undistortion table in %s', w, h, cache)
+        return self
+
+    # pts: (..., 2) in OpenCV pixel coords (centres at integers).
+    def undistort(self, pts):
+        pts = np.asarray(pts, np.float32)
+        if self.identity or not pts.size:
+            return pts
+        flat = pts.reshape(1, -1, 2)
+        out = cv2.remap(self.table, flat, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return out.reshape(pts.shape)
+
+    # For remapping whole images, made the first time a viewer wants it.
+    def maps(self):
+        if self._maps is None:
+            self._maps = cv2.initUndistortRectifyMap(self.K, self.dist, None, self.K,
+                self.size, cv2.CV_16SC2)
+        return self._maps
+
+    def remap(self, image):
+        if self.identity:
+            return image
+        (m1, m2) = self.maps()
+        return cv2.remap(image, m1, m2, cv2.INTER_LINEAR)
+
+
+def default(size):
+    (w, h) = size
+    return Calibration(size, [[FOCAL, 0, w // 2], [0, FOCAL, h // 2], [0, 0, 1]], np.zeros(5))
+
+
+def res_of(name):
+    (w, h) = name.stem.split('-')[1].split('x')
+    return (int(w), int(h))
+
+
+def load(path, cam, size):
+    if not path:
+        return default(size)
+    path = Path(path)
+    (w, h) = size = tuple(size)
+    files = {res_of(x): x for x in path.glob(f'cam{cam}-*x*.json')}
+    if size in files:
+        name = files[size]
+    else:
+        # the largest with the same aspect ratio, scaled to ours
+        same = [r for r in sorted(files) if r[0] * h == r[1] * w]
+        if not same:
+            log.warning('no calibration for cam%d at %dx%d in %s', cam, w, h, path)
+            return default(size)
+        name = files[same[-1]]
+
+    data = json.loads(name.read_text())
+    K = np.array(data['camera_matrix'], np.float64)
+    K[:2] *= w / res_of(name)[0]
+    log.info('calibration for %dx%d from %s', w, h, name.name)
+    return Calibration(size, K, data.get('dist_coeffs', np.zeros(5)), path)
+
+
+# EOF
@@ -0,0 +1,170 @@
+# Detection stream for tools that don't speak NT.
+#
+# GET /detections gives one JSON record per frame, as newline-delimited
+# JSON, or as server-sent events with ?format=sse (or Accept:
+# text/event-stream).  Filters: ?ids=1,4,7 (tag ids), ?margin=30 (min
+# decision margin), ?hz=10 (at most this many records per second).
+#
+#   {"seq": 1234, "t": 5678.9012, "cam": 0, "jobs": ["tag", "ring"],
+#    "ring": [x, y, w, h] or null,
+#    "tags": [{"id": 7, "margin": 183.2, "center": [x, y],
+#              "corners": [[x, y], ...]}, ...]}
+#
+# t is the capture time (time.monotonic() on the Pi), positions are
+# pixels, undistorted if there's a lens calibration.  A record is only
+# built if someone's listening.  Each tag is serialized once per frame and
+# each distinct filter's record once, shared by every subscriber using
+# it.  A subscriber that falls QUEUE records behind is disconnected rather
+# than buffered for.
+
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+QUEUE = 8       # records a subscriber may have waiting before it's dropped
+
+log = logging.getLogger('det')
+
+
+# One frame's results, as handed over by the vision thread.
+class Frame:
+    def __init__(self, rec):
+        (self.seq, self.t, self.cam, self.jobs, self.tags, self.points, self.ring) = rec
+        self.frags = None
+        self.rendered = {}  # (ids, margin, sse): bytes
+
+    def fragments(self):
+        if self.frags is None:
+            self.frags = [json.dumps(dict(id=tid, margin=round(margin, 1),
+                center=[round(float(x), 2) for x in pts[4]],
+                corners=[[round(float(x), 2) for x in c] for c in pts[:4]]),
+                separators=(',', ':')).encode()
+                for ((tid, margin), pts) in zip(self.tags, self.points)]
+        return self.frags
+
+    def render(self, ids, margin, sse):
+        key = (ids, margin, sse)
+        data = self.rendered.get(key)
+        if data is None:
+            frags = [f for ((tid, m), f) in zip(self.tags, self.fragments())
+                if (ids is None or tid in ids) and m >= margin]
+            body = (f'{{"seq":{self.seq},"t":{self.t:.4f},"cam":{self.cam},'
+                f'"jobs":{json.dumps(self.jobs, separators=(",", ":"))},'
+                f'"ring":{json.dumps(self.ring, separators=(",", ":"))},"tags":[').encode()
+            body += b','.join(frags) + b']}'
+            data = self.rendered[key] = (b'id: %d\ndata: %s\n\n' % (self.seq, body)) if sse else body + b'\n'
+        return data
+
+
+class Subscriber:
+    def __init__(self, query, sse):
+        try:
+            self.ids = frozenset(int(x) for x in query['ids'].split(',')) if query.get('ids') else None
+            self.margin = float(query.get('margin', 0))
+            self.hz = float(query.get('hz', 0))
+        except ValueError as ex:
+            raise web.HTTPBadRequest(text=str(ex))
+        if self.hz < 0:
+            raise web.HTTPBadRequest(text='need hz >= 0')
+        self.sse = sse
+        self.queue = asyncio.Queue(QUEUE)
+        self.due = 0.0
+        self.dropped = False
+        self.transport = None
+
+    # Called on the loop for each frame; never waits.
+    def offer(self, frame):
+        if self.hz:
+            if frame.t < self.due:
+                return
+            period = 1 / self.hz
+            # keep to the rate on average, but don't burst after a gap
+            self.due = self.due + period if frame.t - self.due < period else frame.t + period
+        try:
+            self.queue.put_nowait(frame.render(self.ids, self.margin, self.sse))
+        except asyncio.QueueFull:
+            self.dropped = True
+
+
+class Hub:
+    def __init__(self):
+        self.clients = set()
+        self.records = 0
+        self.dropped = 0
+
+    # rec: (seq, t, cam, jobs, [(id, margin)], points, ring), see
+    # Processor.run().  Called on the loop, via the handoff.
+    def publish(self, rec):
+        if not self.clients:
+            return
+        frame = Frame(rec)
+        for client in list(self.clients):
+            client.offer(frame)
+            if client.dropped:
+                self.drop(client)
+        self.records += 1
+
+    # Its handler is likely stuck waiting for the socket to drain, so cut
+    # the connection from under it.
+    def drop(self, client):
+        self.clients.discard(client)
+        self.dropped += 1
+        log.info('dropped a slow subscriber')
+        if client.transport:
+            client.transport.abort()
+
+
+    # Prometheus text format, for /metrics.
+    def metrics(self):
+        return '\n'.join([
+            '# HELP detections_subscribers Clients on /detections.',
+            '# TYPE detections_subscribers gauge',
+            f'detections_subscribers {len(self.clients)}',
+            '# HELP detections_frames_total Frames published to /detections.',
+            '# TYPE detections_frames_total counter',
+            f'detections_frames_total {self.records}',
+            '# HELP detections_dropped_total Subscribers dropped for falling behind.',
+            '# TYPE detections_dropped_total counter',
+            f'detections_dropped_total {self.dropped}',
+            ]) + '\n'
+
+
+hub = Hub()
+
+
+async def stream(request):
+    sse = (request.query.get('format') == 'sse'
+        or 'text/event-stream' in request.headers.get('Accept', ''))
+    client = Subscriber(request.query, sse)
+    response = web.StreamResponse(
+        status=200,
+        reason='OK',
+        headers={'Content-Type': 'text/event-stream' if sse else 'application/x-ndjson',
+            'Cache-Control': 'no-cache, private',
+            }
+        )
+    await response.prepare(request)
+    client.transport = request.transport
+
+    hub.clients.add(client)
+    try:
+        while True:
+            data = await client.queue.get()
+            if client.dropped:
+                break
+            await response.write(data)
+
+    except Exception:
+        pass
+    finally:
+        hub.clients.discard(client)
+        try:
+            await response.write_eof()
+        except Exception:
+            pass
+    return response
+
+
+# EOF
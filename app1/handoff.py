@@ -0,0 +1,92 @@
+# Vision thread to event loop, once per frame.
+#
+# Whatever the vision thread has for the loop during a frame (the new
+# frame for the streams, its detections, messages for the UI) is
+# collected here and handed over with a single call_soon_threadsafe() at
+# the end of the frame.  Each of those wakes the loop through its
+# self-pipe, so this is one wakeup per frame rather than one per message.
+# If the loop hasn't got to the last batch yet, the next one is merged
+# into it instead of scheduling another.
+
+import threading
+
+
+class Batch:
+    def __init__(self):
+        self.frame = False  # a new frame is out, see vision.output
+        self.msgs = []      # (msg, kwargs) for the websocket clients
+        self.results = []   # detection records, see detections.Hub.publish()
+
+
+class Handoff:
+    def __init__(self, loop, sender, on_frame, on_result):
+        self.loop = loop
+        self.sender = sender
+        self.on_frame = on_frame
+        self.on_result = on_result
+        self.lock = threading.Lock()
+        self.batch = Batch()    # being filled by the vision thread
+        self.queued = None      # handed over, not delivered yet
+        self.frames = 0
+        self.wakeups = 0
+        self.merged = 0
+        self.msgs = 0
+
+    # The rest is called from the vision thread, except for _deliver().
+    def send(self, msg, **kwargs):
+        self.batch.msgs.append((msg, kwargs))
+
+    def frame(self):
+        self.batch.frame = True
+
+    def result(self, rec):
+        self.batch.results.append(rec)
+
+    def flush(self):
+        batch = self.batch
+        if not batch.frame and not batch.msgs and not batch.results:
+            return
+        self.batch = Batch()
+        if batch.frame:
+            self.frames += 1
+        with self.lock:
+            if self.queued:
+                self.queued.frame |= batch.frame
+                self.queued.msgs += batch.msgs
+                self.queued.results += batch.results
+                self.merged += 1
+                return
+            self.queued = batch
+        self.wakeups += 1
+        self.loop.call_soon_threadsafe(self._deliver)
+
+    def _deliver(self):
+        with self.lock:
+            (batch, self.queued) = (self.queued, None)
+        if batch.frame:
+            self.on_frame()
+        for rec in batch.results:
+            self.on_result(rec)
+        for (msg, kwargs) in batch.msgs:
+            self.sender(msg, **kwargs)
+        self.msgs += len(batch.msgs)
+
+
+    # Prometheus text format, for /metrics.
+    def metrics(self):
+        lines = []
+        for (name, what) in (
+                ('frames', 'Frames handed to the event loop.'),
+                ('wakeups', 'Event loop wakeups from the vision thread.'),
+                ('merged', 'Batches merged into one the loop had not yet run.'),
+                ('msgs', 'Websocket messages delivered.'),
+                ):
+            lines += [
+                f'# HELP handoff_{name}_total {what}',
+                f'# TYPE handoff_{name}_total counter',
+                f'handoff_{name}_total {getattr(self, name)}',
+                ]
+        return '\n'.join(lines) + '\n'
+
+
+# EOF
@@ -0,0 +1,84 @@
+# Non-blocking logging.
+#
+# Records go into a fixed-size ring buffer and a background thread writes
+# them out, so a slow terminal, SSH link or journal can't stall the vision
+# thread.  If the writer falls behind the oldest records are dropped (and
+# counted) rather than blocking or growing without bound.  The time spent
+# queueing records is tallied, so callers can report logging cost per frame.
+
+import collections
+import logging
+import logging.handlers
+import threading
+import time
+
+FORMAT = '%(levelname)s:%(name)s:%(message)s'   # same as basicConfig's
+
+
+class RingQueue:
+    def __init__(self, size=2000):
+        self._q = collections.deque(maxlen=size)
+        self._ready = threading.Event()
+        self.dropped = 0
+
+    def put_nowait(self, record):
+        q = self._q
+        if len(q) == q.maxlen:
+            self.dropped += 1
+        q.append(record)
+        self._ready.set()
+
+    # Only the listener thread calls this.
+    def get(self, block=True):
+        while True:
+            try:
+                return self._q.popleft()
+            except IndexError:
+                if not block:
+                    raise
+                self._ready.wait()
+                self._ready.clear()
+
+
+class TimedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.count = 0
+        self.elapsed = 0    # ns spent in emit(), i.e. in the caller's thread
+
+    def emit(self, record):
+        t0 = time.perf_counter_ns()
+        super().emit(record)
+        self.elapsed += time.perf_counter_ns() - t0
+        self.count += 1
+
+    # Returns and resets (records, seconds) spent logging since last call.
+    def take(self):
+        count, elapsed = self.count, self.elapsed
+        self.count = self.elapsed = 0
+        return count, elapsed / 1e9
+
+
+queue = RingQueue()
+handler = TimedQueueHandler(queue)
+listener = None
+
+
+def setup(level=logging.INFO):
+    global listener
+    out = logging.StreamHandler()
+    out.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(queue, out, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def stop():
+    if listener:
+        listener.stop()
+
+
+# EOF
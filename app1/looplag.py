@@ -0,0 +1,126 @@
+# Event loop health.
+#
+# The web server, every websocket sender and the MJPEG writers share one
+# loop, so a stalled UI could be the loop or could be vision.  A sampler
+# task sleeps for PERIOD and records how late it wakes up (scheduling
+# lag) in a histogram, and with watch_callbacks() (--slowcb, off by
+# default) every callback is timed so a slow one can be logged by name.
+# Both go to /metrics, and the recent worst lag goes on vision's status
+# line.
+#
+# --loop uvloop runs on uvloop instead, if it's installed.  Its callbacks
+# don't go through asyncio's Handle, so the slow-callback detector can't
+# name them there; the lag sampler works the same either way.
+
+import asyncio
+import bisect
+import logging
+import time
+
+PERIOD = 0.1    # seconds between lag samples
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0) # histogram, seconds
+
+log = logging.getLogger('loop')
+
+
+def loop_factory(name):
+    if name == 'uvloop':
+        try:
+            import uvloop
+            return uvloop.new_event_loop
+        except ImportError:
+            log.warning('uvloop not installed, using asyncio loop')
+    return None
+
+
+class Monitor:
+    def __init__(self):
+        self.kind = None
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.samples = 0
+        self.peak = 0.0     # worst lag since take()
+        self.threshold = 0  # slow callback threshold, see watch_callbacks()
+        self.slow = 0       # callbacks over the threshold
+        self.slowest = 0.0
+
+    def record(self, lag):
+        self.counts[bisect.bisect_left(BUCKETS, lag)] += 1
+        self.total += lag
+        self.samples += 1
+        self.peak = max(self.peak, lag)
+
+    # Returns and resets the worst lag since the last call.
+    def take(self):
+        (peak, self.peak) = (self.peak, 0.0)
+        return peak
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.kind = type(loop).__module__.split('.')[0]
+        log.info('running on %s loop', self.kind)
+        if self.threshold and self.kind != 'asyncio':
+            log.warning('slow callback timing has no effect on the %s loop', self.kind)
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(PERIOD)
+            self.record(max(0.0, loop.time() - t0 - PERIOD))
+
+
+    # Prometheus text format, for /metrics.
+    def metrics(self):
+        lines = [
+            '# HELP loop_lag_seconds Event loop scheduling lag, from a sleeping sampler.',
+            '# TYPE loop_lag_seconds histogram',
+            ]
+        n = 0
+        for (le, count) in zip(BUCKETS, self.counts):
+            n += count
+            lines.append(f'loop_lag_seconds_bucket{{le="{le}"}} {n}')
+        lines += [
+            f'loop_lag_seconds_bucket{{le="+Inf"}} {self.samples}',
+            f'loop_lag_seconds_sum {self.total:.6f}',
+            f'loop_lag_seconds_count {self.samples}',
+            '# HELP loop_slow_callbacks_total Callbacks that ran over the slow threshold.',
+            '# TYPE loop_slow_callbacks_total counter',
+            f'loop_slow_callbacks_total {self.slow}',
+            '# HELP loop_slowest_callback_seconds Longest callback seen.',
+            '# TYPE loop_slowest_callback_seconds gauge',
+            f'loop_slowest_callback_seconds {self.slowest:.6f}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+monitor = Monitor()
+
+
+# What a handle will run, by name: for a task step, the task's coroutine.
+def describe(handle):
+    cb = getattr(handle, '_callback', None)
+    task = getattr(cb, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        return f'task {task.get_name()} {getattr(coro, "__qualname__", coro)}'
+    return getattr(cb, '__qualname__', repr(cb))
+
+
+# Time every callback the asyncio loop runs, and log any taking longer
+# than threshold seconds.  Like the loop's own debug mode, but without
+# its other overheads.
+def watch_callbacks(threshold):
+    monitor.threshold = threshold
+    run = asyncio.events.Handle._run
+
+    def timed(handle):
+        t0 = time.perf_counter()
+        run(handle)
+        elapsed = time.perf_counter() - t0
+        if elapsed >= threshold:
+            monitor.slow += 1
+            monitor.slowest = max(monitor.slowest, elapsed)
+            log.warning('slow callback %.1fms: %s', elapsed * 1e3, describe(handle))
+
+    asyncio.events.Handle._run = timed
+
+
+# EOF
@@ -5,12 +5,10 @@ from pathlib import Path
 import signal
 import sys
 
-from . import vision, web
+from . import logs, looplag, startup, vision, web
 from .net_tables import NT
 from .utils import log_uncaught
 
-logging.basicConfig(level=logging.DEBUG)
-
 
 #-----------------------------
 
@@ -18,6 +16,7 @@ class Core:
     def __init__(self):
         self.log = logging.getLogger('core')
         self.task = None
+        self.web = None
 
     def running(self):
         return not self._shutdown.is_set()
@@ -30,7 +29,8 @@ class Core:
         try:
             self._shutdown.set()
 
-            await self.web.stop()
+            if self.web:
+                await self.web.stop()
 
             if self.task:
                 self.task.cancel()
@@ -76,12 +76,38 @@ class Core:
             self.loop.add_signal_handler(sig, self.handle_sig)
             # self.log.debug('installed handler for', sig)
 
-        self.web = await web.start(args)
-
+        # Independent init steps run concurrently: vision opens the camera
+        # and builds the detector while NT connects and the web server
+        # comes up.
+        services = asyncio.create_task(self.start_services(args))
+        services.add_done_callback(self.services_done)
+        lag = asyncio.create_task(looplag.monitor.run())
         try:
             await vision.run(args, web.send_all)
         finally:
-            await self.web.stop()
+            lag.cancel()
+            await services  # raises what stopped it, if anything did
+            if self.web:
+                await self.web.stop()
+
+
+    # No point running vision with nothing to serve it.
+    def services_done(self, task):
+        if not task.cancelled() and task.exception():
+            self.task.cancel()
+
+
+    @log_uncaught
+    async def start_services(self, args):
+        steps = [web.start(args)]
+        if not args.mocknt:
+            steps.append(asyncio.to_thread(start_nt, args))
+        (self.web, *_) = await asyncio.gather(*steps)
+
+
+def start_nt(args):
+    with startup.timeline.step('nt'):
+        NT.start(args)
 
 
 def main():
@@ -95,18 +121,40 @@ def main():
     parser.add_argument('--dec', type=int, default=2)
     parser.add_argument('--threads', type=int, default=4)
     parser.add_argument('--fps', type=float, default=60.0)
+    parser.add_argument('--pace', type=float, default=0.0) # process at most this many fps, 0=every frame
+    parser.add_argument('--tune', type=float, default=0.0) # target FPS, 0=off (headless: --fps)
+    parser.add_argument('--calib') # dir of cam<N>-<W>x<H>.json lens calibrations
+    parser.add_argument('--ring', default='hsv',
+        choices=['hsv', 'chroma']) # main HSV, or lores U/V planes (4x less work)
+    parser.add_argument('--sched', default='auto',
+        choices=['auto', 'intake', 'aim', 'all']) # auto follows NT motor
     # parser.add_argument('--time', type=float, default=10.0)
+    parser.add_argument('--raw', default='auto',
+        choices=['auto', 'sw', 'off']) # /raw.mjpeg encoder, auto=camera's if it has one
+    parser.add_argument('--headless', action='store_true') # detection only, see web.headless_gate
+    parser.add_argument('--udp') # host:port for per-frame detection datagrams
+    parser.add_argument('--record') # dir for recorded segments
+    parser.add_argument('--replay') # recording or synth dir to run instead of camera
+    parser.add_argument('--stall', type=float, default=0.0) # replay stalls after this many s, for testing recovery
     parser.add_argument('--team', type=int, default=8089)
     parser.add_argument('--mocknt', action='store_true')
+    parser.add_argument('--ntdeadband', type=float, default=1) # px, tag-x/y
+    parser.add_argument('--ntkeepalive', type=float, default=0.5) # s
+    parser.add_argument('--ntrate', type=float, default=100.0) # max updates/s per topic, 0=no cap
+    parser.add_argument('--loop', default='asyncio', choices=['asyncio', 'uvloop'])
+    parser.add_argument('--slowcb', type=float, default=0.0) # s, log callbacks slower than this (e.g. 0.05), 0=off
 
     args = parser.parse_args()
 
-    if not args.mocknt:
-        NT.start(args)
-
+    logs.setup(logging.DEBUG)
+    NT.configure(args)
+    startup.timeline.mark('main')  # i.e. after our imports
+    if args.slowcb:
+        looplag.watch_callbacks(args.slowcb)
     core = Core()
     try:
-        asyncio.run(core.run(args))
+        with asyncio.Runner(loop_factory=looplag.loop_factory(args.loop)) as runner:
+            runner.run(core.run(args))
         # web.run_app(app)
     except (SystemExit, KeyboardInterrupt):
         pass
@@ -114,4 +162,5 @@ def main():
         if not args.mocknt:
             NT.running.set(False)
             NT.stop()
+        logs.stop()
 
@@ -1,8 +1,13 @@
 import json
 import logging
 import re
+import threading
+import time
 
-import ntcore
+# Defaults for throttled topics, see Throttled.
+DEADBAND = 1        # ignore changes this small or smaller
+KEEPALIVE = 0.5     # seconds, resend an unchanged value this often
+MAX_RATE = 100.0    # updates per second at most
 
 
 class mock:
@@ -10,19 +15,61 @@ class mock:
     def set(*_): pass
 
 
+# Publishes a value only when it has moved past the deadband since the
+# last one sent, or the keepalive is up, and never faster than max_rate.
+# Callers set() every frame as before; a change held back by the rate
+# cap goes out on the first set() after it allows.  Counts what it sent
+# and what it held back, per topic.
+class Throttled:
+    def __init__(self, topic, pub=None):
+        self.topic = topic
+        self.pub = pub or mock()
+        self.deadband = DEADBAND
+        self.keepalive = KEEPALIVE
+        self.interval = 1 / MAX_RATE
+        self.last = None
+        self.sent_at = -1e9
+        self.published = 0
+        self.suppressed = 0
+
+    def set(self, value):
+        now = time.monotonic()
+        since = now - self.sent_at
+        moved = self.last is None or abs(value - self.last) > self.deadband
+        if (moved and since >= self.interval) or since >= self.keepalive:
+            self.pub.set(value)
+            self.last = value
+            self.sent_at = now
+            self.published += 1
+        else:
+            self.suppressed += 1
+
+    def get(self):
+        return self.last or 0
+
+
 class Nt:
     def __init__(self):
         self.log = logging.getLogger('nt')
+        self.lock = threading.Lock()
+        self.ready = False
+        self.health = (0, 0, False)
+        self.tag_x = Throttled('/Vision/tag-x')
+        self.tag_y = Throttled('/Vision/tag-y')
+        self.throttled = [self.tag_x, self.tag_y]
 
     # mock stuff... will be shadowed by real pub/sub/entries if not mocking
     running = mock()
     motor = mock()
-    tag_x = mock()
-    tag_y = mock()
     dist1 = mock()
     beam1 = mock()
+    stalls = mock()
+    recoveries = mock()
+    degraded = mock()
 
     def start(self, args):
+        import ntcore   # here so startup doesn't wait on it, and --mocknt never loads it
+
         self._nt = ntcore.NetworkTableInstance.getDefault()
         self._nt.setServerTeam(args.team)
         self._nt.startClient4('fire1') # TODO: use hostname or arg
@@ -34,19 +81,64 @@ class Nt:
             sn = '?'
         self.vis_serial.set(sn)
 
-        self.running = self._nt.getBooleanTopic('/Vision/running').publish()
-        self.running.set(True)
+        # false until vision has warmed up, see set_ready()
+        with self.lock:
+            self.running = self._nt.getBooleanTopic('/Vision/running').publish()
+            self.running.set(self.ready)
+            self.stalls = self._nt.getIntegerTopic('/Vision/stalls').publish()
+            self.recoveries = self._nt.getIntegerTopic('/Vision/recoveries').publish()
+            self.degraded = self._nt.getBooleanTopic('/Vision/degraded').publish()
+            (stalls, recoveries, degraded) = self.health
+            self.stalls.set(stalls)
+            self.recoveries.set(recoveries)
+            self.degraded.set(degraded)
 
-        self.tag_x = self._nt.getIntegerTopic('/Vision/tag-x').publish()
-        self.tag_x.set(0)
-        self.tag_y = self._nt.getIntegerTopic('/Vision/tag-y').publish()
-        self.tag_y.set(0)
+        for t in self.throttled:
+            t.pub = self._nt.getIntegerTopic(t.topic).publish()
+            t.pub.set(t.last or 0)
         self.motor = self._nt.getBooleanTopic('/Vision/motor').getEntry(False)
         self.motor.set(False)
         self.dist1 = self._nt.getIntegerTopic('/Vision/Dist1').subscribe(0)
         self.beam1 = self._nt.getBooleanTopic('/Shuffleboard/Digital/Beam Break Sensor >:3').subscribe(False)
 
 
+    def configure(self, args):
+        for t in self.throttled:
+            t.deadband = args.ntdeadband
+            t.keepalive = args.ntkeepalive
+            t.interval = 1 / args.ntrate if args.ntrate > 0 else 0
+
+
+    # Prometheus text format, for /metrics.
+    def metrics(self):
+        lines = []
+        for (name, what) in (('published', 'sent'), ('suppressed', 'held back by deadband or rate cap')):
+            lines += [
+                f'# HELP nt_{name}_total NT updates {what}.',
+                f'# TYPE nt_{name}_total counter',
+                ]
+            lines += [f'nt_{name}_total{{topic="{t.topic}"}} {getattr(t, name)}' for t in self.throttled]
+        return '\n'.join(lines) + '\n'
+
+
+    # Vision is warmed up and delivering frames.  Startup runs this and
+    # start() concurrently, so whichever goes second publishes it.
+    def set_ready(self, ready=True):
+        with self.lock:
+            self.ready = ready
+            self.running.set(ready)
+
+
+    # Camera stalls and recoveries so far, and whether frames have stopped
+    # coming right now; see vision.watchdog().
+    def set_health(self, stalls, recoveries, degraded):
+        with self.lock:
+            self.health = (stalls, recoveries, degraded)
+            self.stalls.set(stalls)
+            self.recoveries.set(recoveries)
+            self.degraded.set(degraded)
+
+
     def stop(self):
         try:
             self._nt.stopClient()
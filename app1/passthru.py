@@ -0,0 +1,208 @@
+# Camera passthrough stream.
+#
+# A second MJPEG stream of the raw (lores) camera frames for viewers who
+# just want to see the field.  On a Pi the frames go straight from the
+# camera to Picamera2's MJPEG encoder (hardware where there is one) and
+# its output thread hands each JPEG to the event loop, so the vision
+# thread never sees them.  Elsewhere, or if that encoder can't start,
+# SoftwareEncoder does the same job on the CPU in its own thread.
+#
+# Either way the encoder only runs while someone is watching: the first
+# viewer starts it and the last one stops it, so an unwatched stream costs
+# no encoding and no event loop wakeups.
+
+import asyncio
+import io
+import logging
+import threading
+
+import cv2
+from aiohttp import web
+
+QUALITY = 80    # software encoder JPEG quality
+
+log = logging.getLogger('raw')
+
+
+# File-like, as Picamera2's FileOutput wants.  write() is called in the
+# encoder's thread, once per JPEG.
+class Passthrough(io.BufferedIOBase):
+    def __init__(self):
+        self.loop = None
+        self.frame = None
+        self.count = 0
+        self.clients = 0
+        self.waiter = None
+        self.mode = 'off'       # see start()
+        self.cam = None
+        self.encoder = None     # name of the running one, for the log
+        self.lock = threading.Lock()    # for starting and stopping it
+
+    def write(self, buf):
+        # the last viewer's gone and the encoder's about to stop
+        if not self.clients:
+            return len(buf)
+        # the camera encoder reuses its buffer once we return
+        self.loop.call_soon_threadsafe(self._publish, bytes(buf))
+        return len(buf)
+
+    def _publish(self, buf):
+        self.frame = buf
+        self.count += 1
+        if self.waiter:
+            self.waiter.set_result(buf)
+            self.waiter = None
+
+    # Every waiting client gets the same frame.  Shielded, since a client
+    # going away mustn't cancel it for the others.
+    def next(self):
+        if not self.waiter:
+            self.waiter = self.loop.create_future()
+        return asyncio.shield(self.waiter)
+
+
+output = Passthrough()
+
+
+# For when there's no camera encoder: encodes the latest frame fed to it,
+# dropping any it couldn't get to.
+class SoftwareEncoder:
+    def __init__(self, quality=QUALITY):
+        self.quality = quality
+        self.output = None
+        self.pending = None
+        self.ready = threading.Event()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name='raw-encoder', daemon=True)
+
+    def start(self, output):
+        self.output = output
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+        self.thread.join()
+
+    # Called from the capture thread with a YUV420 frame; costs nothing.
+    def feed(self, yuv):
+        if self.output.clients:
+            self.pending = yuv
+            self.ready.set()
+
+    def run(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        while self.running:
+            self.ready.wait()
+            self.ready.clear()
+            (yuv, self.pending) = (self.pending, None)
+            if yuv is None:
+                continue
+            img = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420)
+            okay, buf = cv2.imencode('.jpg', img, params)
+            if okay:
+                self.output.write(buf.tobytes())
+
+
+# The camera to stream from, once it's started (and again whenever it's
+# restarted, which leaves it without an encoder).
+def start(cam, loop, mode='auto'):
+    output.loop = loop
+    with output.lock:
+        output.mode = mode
+        output.cam = None if mode == 'off' else cam
+        output.encoder = None
+        if output.cam and output.clients:
+            start_encoder(output.cam, mode)
+
+
+# Before the camera's stopped for a reconfigure.
+def stop(cam):
+    with output.lock:
+        if output.encoder:
+            cam.stop_encoder()
+            output.encoder = None
+
+
+# Start or stop the encoder to match whether anyone's watching.  Either
+# can take a while, so the loop runs this in a worker thread.
+def update():
+    with output.lock:
+        if not output.cam:
+            return
+        if output.clients and not output.encoder:
+            start_encoder(output.cam, output.mode)
+        elif not output.clients and output.encoder:
+            output.cam.stop_encoder()
+            output.encoder = None
+            log.info('raw stream stopped')
+
+
+# Hook an encoder up to the camera's lores stream: the camera's own MJPEG
+# encoder (hardware on a Pi 4), else a software one.
+def start_encoder(cam, mode):
+    from . import sources
+
+    try:
+        if isinstance(cam, sources.Source):
+            cam.start_encoder(SoftwareEncoder(), output, name='lores')
+            output.encoder = 'software'
+        else:
+            from picamera2.encoders import JpegEncoder, MJPEGEncoder
+            from picamera2.outputs import FileOutput
+            try:
+                if mode == 'sw':
+                    raise RuntimeError('software encoder requested')
+                cam.start_encoder(MJPEGEncoder(), FileOutput(output), name='lores')
+                output.encoder = 'camera'
+            except Exception as ex:
+                log.warning('camera encoder unavailable (%s), using software', ex)
+                cam.start_encoder(JpegEncoder(q=QUALITY), FileOutput(output), name='lores')
+                output.encoder = 'picamera2 software'
+    except Exception:
+        log.exception('raw stream failed')
+        return
+
+    log.info('raw stream using %s encoder', output.encoder)
+
+
+async def stream(request):
+    if output.mode == 'off':
+        raise web.HTTPServiceUnavailable(text='raw stream off')
+
+    response = web.StreamResponse(
+        status=200,
+        reason='OK',
+        headers={'Content-Type': 'multipart/x-mixed-replace; boundary=FRAME',
+            'Age': '0',
+            'Cache-Control': 'no-cache, private',
+            'Pragma': 'no-cache',
+            }
+        )
+    await response.prepare(request)
+
+    output.clients += 1
+    try:
+        await asyncio.to_thread(update)
+        while True:
+            frame = await output.next()
+            await response.write(b'--FRAME\r\nContent-Type: image/jpeg\r\n'
+                + f'Content-Length: {len(frame)}\r\n\r\n'.encode())
+            await response.write(frame)
+            await response.write(b'\r\n')
+
+    except Exception:
+        pass
+    finally:
+        output.clients -= 1
+        if not output.clients:
+            asyncio.create_task(asyncio.to_thread(update))
+        try:
+            await response.write_eof()
+        except Exception:
+            pass
+    return response
+
+
+# EOF
@@ -0,0 +1,185 @@
+# Background match recorder.
+#
+# The vision thread hands each frame's lores capture, encoded JPEG and
+# detections to record(), which only queues references (no copies, never
+# blocks).  A writer thread stores them in preallocated, memory-mapped
+# segment files and rotates to a new segment when one fills.  If the disk
+# can't keep up the queue fills and frames are dropped and counted.
+#
+# Segment layout (one directory each, seg-00001 etc):
+#   lores.npy   (N, H*3/2, W) uint8 YUV420 frames
+#   jpeg.bin    N * JPEG_BUDGET bytes, JPEGs packed back to back
+#   index.npy   (N,) INDEX records: seq, time, JPEG offset/length, detections
+#
+# sources.ReplaySource plays recordings back through the pipeline.
+
+import logging
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+
+MAX_TAGS = 8
+JPEG_BUDGET = 96 * 1024     # average bytes per frame reserved for JPEGs
+
+TAG = np.dtype([
+    ('id', 'i2'),
+    ('margin', 'f4'),
+    ('center', 'f4', 2),
+    ('corners', 'f4', (4, 2)),
+    ])
+
+INDEX = np.dtype([
+    ('valid', 'u1'),
+    ('seq', 'u8'),
+    ('t', 'f8'),            # time.monotonic() at capture
+    ('jpeg_off', 'u8'),
+    ('jpeg_len', 'u4'),     # 0 if no JPEG or it didn't fit
+    ('ring', 'i4', 4),      # x, y, w, h; w=0 if none
+    ('ntags', 'u1'),
+    ('tags', TAG, MAX_TAGS),
+    ])
+
+
+def preallocate(path, size):
+    # Reserve the blocks now so a long match can't fragment or run out
+    # of space part way through a segment.
+    with open(path, 'r+b') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            pass
+
+
+class Segment:
+    def __init__(self, path, count, shape):
+        self.path = path
+        path.mkdir(parents=True)
+        self.count = count
+        self.lores = np.lib.format.open_memmap(path / 'lores.npy', 'w+', np.uint8, (count, *shape))
+        self.index = np.lib.format.open_memmap(path / 'index.npy', 'w+', INDEX, (count,))
+        size = count * JPEG_BUDGET
+        with open(path / 'jpeg.bin', 'wb') as f:
+            f.truncate(size)
+        for name in ('lores.npy', 'index.npy', 'jpeg.bin'):
+            preallocate(path / name, os.path.getsize(path / name))
+        self.jpeg = np.memmap(path / 'jpeg.bin', np.uint8, 'r+', shape=(size,))
+        self.n = 0
+        self.jpeg_end = 0
+
+    def full(self):
+        return self.n >= self.count
+
+    def write(self, seq, t, lores, jpeg, tags, ring):
+        i = self.n
+        rec = self.index[i]
+        self.lores[i] = lores
+
+        if jpeg is not None and self.jpeg_end + len(jpeg) <= len(self.jpeg):
+            self.jpeg[self.jpeg_end:self.jpeg_end + len(jpeg)] = np.frombuffer(jpeg, np.uint8)
+            rec['jpeg_off'] = self.jpeg_end
+            rec['jpeg_len'] = len(jpeg)
+            self.jpeg_end += len(jpeg)
+
+        if ring:
+            rec['ring'] = ring
+        tags = tags[:MAX_TAGS]
+        rec['ntags'] = len(tags)
+        for (j, tag) in enumerate(tags):
+            c = tag.getCenter()
+            rec['tags'][j] = (tag.getId(), tag.getDecisionMargin(), (c.x, c.y),
+                [(tag.getCorner(k).x, tag.getCorner(k).y) for k in range(4)])
+
+        rec['seq'] = seq
+        rec['t'] = t
+        rec['valid'] = 1
+        self.n += 1
+
+    def close(self):
+        for arr in (self.lores, self.index, self.jpeg):
+            arr.flush()
+
+
+def open_segment(path):
+    path = Path(path)
+    lores = np.load(path / 'lores.npy', mmap_mode='r')
+    index = np.load(path / 'index.npy', mmap_mode='r')
+    jpeg = np.memmap(path / 'jpeg.bin', np.uint8, 'r')
+    n = int(index['valid'].sum())
+    return lores[:n], jpeg, index[:n]
+
+
+def segments(path):
+    return sorted(Path(path).glob('seg-*'))
+
+
+class Recorder:
+    def __init__(self, path, frames=900, keep=12, backlog=64):
+        self.path = Path(path)
+        self.frames = frames    # per segment, e.g. 15s at 60 FPS
+        # segments kept, oldest removed first; each is frames x (lores +
+        # JPEG_BUDGET + INDEX), ~500MB at 640x480 (415 + 88 + 0.4)
+        self.keep = keep
+        self.log = logging.getLogger('rec')
+        self.q = queue.Queue(backlog)
+        self.seg = None
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='recorder', daemon=True)
+
+        old = segments(self.path)
+        self.next_num = int(old[-1].name[4:]) + 1 if old else 1
+
+    def start(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.q.put(None)
+        self.thread.join()
+
+    # Called from the vision thread.  The arrays must not be reused by the
+    # caller afterwards (capture_arrays() and imencode() give fresh ones).
+    def record(self, seq, t, lores, jpeg, tags, ring):
+        try:
+            self.q.put_nowait((seq, t, lores, jpeg, tags, ring))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def rotate(self, shape):
+        if self.seg:
+            self.seg.close()
+            self.log.info('closed %s: %d frames, %d dropped so far', self.seg.path.name, self.seg.n, self.dropped)
+
+        old = segments(self.path)
+        for path in old[:max(0, len(old) - self.keep + 1)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+        t0 = time.monotonic()
+        self.seg = Segment(self.path / f'seg-{self.next_num:05d}', self.frames, shape)
+        self.next_num += 1
+        self.log.debug('opened %s in %.3fs', self.seg.path.name, time.monotonic() - t0)
+
+
+    def run(self):
+        try:
+            while (item := self.q.get()) is not None:
+                lores = item[2]
+                if not self.seg or self.seg.full() or self.seg.lores.shape[1:] != lores.shape:
+                    self.rotate(lores.shape)
+                self.seg.write(*item)
+                self.written += 1
+        except Exception:
+            self.log.exception('recorder failed')
+        finally:
+            if self.seg:
+                self.seg.close()
+
+
+# EOF
@@ -0,0 +1,137 @@
+# Per-client stream quality.
+#
+# A viewer can ask for a lower frame rate, a smaller image or a lower JPEG
+# quality (/stream1.mjpeg?fps=10&scale=0.5&q=50), or ?auto=1 to have it
+# picked from how fast the connection drains, and ?undistort=1 to see it
+# through the lens calibration.  Each rendition of a frame is encoded
+# once, in a worker thread, and shared by every client that wants it.
+# The full size, default quality one is the JPEG the vision thread
+# already made.
+
+import asyncio
+import logging
+import socket
+import time
+
+import cv2
+from aiohttp import web
+
+# (scale, quality) from best to worst for auto mode; None = default
+LADDER = [(1.0, None), (1.0, 60), (0.75, 50), (0.5, 50), (0.5, 35), (0.25, 35)]
+STEP_DOWN = 3   # frames in a row skipped for backlog before dropping a level
+STEP_UP = 60    # frames in a row sent with no backlog before trying one better
+SNDBUF = 64 * 1024  # kernel send buffer, small so backlog shows up here quickly
+
+log = logging.getLogger('rend')
+
+
+def encode(image, scale, quality, remap=None):
+    if remap:
+        image = remap(image)
+    if scale != 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else []
+    okay, buf = cv2.imencode('.jpg', image, params)
+    return buf.tobytes() if okay else None
+
+
+class Renditions:
+    def __init__(self):
+        self.seq = None
+        self.jobs = {}      # (scale, quality, remap): Task, for frame self.seq
+        self.encoded = 0
+
+    # frame: (seq, jpeg, image) as the vision thread published it
+    # remap: image -> image, e.g. calib.Calibration.remap
+    async def get(self, frame, scale, quality, remap=None):
+        (seq, jpeg, image) = frame
+        if scale == 1.0 and quality is None and not remap:
+            return jpeg
+
+        if seq != self.seq:
+            self.seq = seq
+            self.jobs = {}
+        key = (scale, quality, remap)
+        job = self.jobs.get(key)
+        if not job:
+            job = self.jobs[key] = asyncio.create_task(
+                asyncio.to_thread(encode, image, scale, quality, remap))
+            self.encoded += 1
+        # shielded: one client going away mustn't cancel it for the others
+        return await asyncio.shield(job)
+
+
+renditions = Renditions()
+
+
+class Viewer:
+    def __init__(self, query, fps):
+        try:
+            self.fps = float(query.get('fps', 0)) or fps or float('inf')  # --fps 0: as fast as we get them
+            self.scale = float(query.get('scale', 1.0))
+            self.quality = int(query['q']) if 'q' in query else None
+        except ValueError as ex:
+            raise web.HTTPBadRequest(text=str(ex))
+        if not 0 < self.scale <= 1 or not 0 < self.fps or self.quality not in (None, *range(5, 101)):
+            raise web.HTTPBadRequest(text='need 0 < scale <= 1, fps > 0, 5 <= q <= 100')
+
+        self.auto = query.get('auto') not in (None, '0')
+        self.undistort = query.get('undistort') not in (None, '0')
+        self.level = 0
+        self.slow = self.fast = 0
+        self.due = 0.0
+        self.sent = 0       # bytes written to the transport
+        self.drained = 0    # ...and gone from it
+        self.rate = 0.0     # bytes/s drained, smoothed
+        self.checked = time.monotonic()
+        self.skipped = 0
+
+    # Keep the kernel from buffering seconds of video for a slow client,
+    # so it shows up as backlog in the transport, where we can see it.
+    def attach(self, transport):
+        sock = transport.get_extra_info('socket') if transport else None
+        if sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF)
+
+    def rendition(self):
+        return LADDER[self.level] if self.auto else (self.scale, self.quality)
+
+    # Whether to send this frame: not if it's ahead of the requested rate,
+    # or the last one is still going out (the client isn't keeping up).
+    def wanted(self, now, transport):
+        queued = transport.get_write_buffer_size() if transport else 0
+        drained = self.sent - queued
+        if now > self.checked:
+            self.rate += 0.2 * ((drained - self.drained) / (now - self.checked) - self.rate)
+        (self.drained, self.checked) = (drained, now)
+
+        if now < self.due:
+            return False
+        if queued:
+            self.skipped += 1
+            self.adjust(slow=True)
+            return False
+        self.due = max(self.due + 1 / self.fps, now - 1 / self.fps)
+        self.adjust(slow=False)
+        return True
+
+    def adjust(self, slow):
+        if not self.auto:
+            return
+        if slow:
+            (self.slow, self.fast) = (self.slow + 1, 0)
+        else:
+            (self.slow, self.fast) = (0, self.fast + 1)
+
+        level = self.level
+        if self.slow >= STEP_DOWN and level < len(LADDER) - 1:
+            level += 1
+        elif self.fast >= STEP_UP and level > 0:
+            level -= 1
+        if level != self.level:
+            log.debug('level %d -> %d %r at %.0f kB/s', self.level, level, LADDER[level], self.rate / 1e3)
+            self.level = level
+            self.slow = self.fast = 0
+
+
+# EOF
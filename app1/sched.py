@@ -0,0 +1,50 @@
+# Frame scheduler for the ring and AprilTag detectors.
+#
+# Each robot mode gives every detector a period (run every Nth frame) and
+# a priority (order within a frame).  In 'auto' the mode follows the
+# /Vision/motor NT entry: intake running means we're hunting rings,
+# otherwise we're lining up on tags.  Frames a detector skips are CPU the
+# other one gets, which the autotuner (if on) turns into lower decimation.
+
+import logging
+
+# mode: [(detector, period), ...] in priority order
+MODES = {
+    'intake': [('ring', 1), ('tag', 4)],
+    'aim': [('tag', 1), ('ring', 4)],
+    'all': [('ring', 1), ('tag', 1)],
+}
+
+
+class Scheduler:
+    def __init__(self, mode='auto'):
+        self.log = logging.getLogger('sched')
+        if mode != 'auto' and mode not in MODES:
+            raise ValueError(f'unknown mode {mode!r}')
+        self.auto = mode == 'auto'
+        self.mode = None
+        self.jobs = []
+        self.frame = 0
+        if not self.auto:
+            self.select(mode)
+
+
+    def select(self, mode):
+        if mode != self.mode:
+            self.log.info('mode %s -> %s', self.mode, mode)
+            self.mode = mode
+            self.jobs = MODES[mode]
+            self.frame = 0  # so everything runs on the first frame
+
+
+    # Names of the detectors to run this frame, highest priority first.
+    def due(self, motor=False):
+        if self.auto:
+            self.select('intake' if motor else 'aim')
+
+        frame = self.frame
+        self.frame += 1
+        return [name for (name, period) in self.jobs if frame % period == 0]
+
+
+# EOF
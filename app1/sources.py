@@ -0,0 +1,155 @@
+# Frame sources other than a live Picamera2, with enough of its interface
+# (capture_arrays, wait, start/stop/close, set_controls) for Processor.run().
+
+import logging
+from pathlib import Path
+import time
+
+import cv2
+import numpy as np
+
+from . import recorder
+
+
+class Source:
+    def __init__(self, size, fps=0):
+        self.size = tuple(size)
+        self.fps = fps
+        self.log = logging.getLogger('src')
+        self.next = None
+        self.encoder = None
+        self.encode = None      # which stream the encoder gets
+
+    def start(self):
+        self.next = time.monotonic()
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Like Picamera2's, but the encoder is fed from capture_arrays().
+    def start_encoder(self, encoder, output, name='lores'):
+        encoder.start(output)
+        self.encoder = encoder
+        self.encode = name
+
+    def stop_encoder(self):
+        if self.encoder:
+            self.encoder.stop()
+            self.encoder = None
+
+    # Picamera2's non-blocking form: capture_arrays(wait=False) gives a
+    # job to wait() on.  Ours are done by then, so the job is the result.
+    def wait(self, job, timeout=None):
+        return job
+
+    def set_controls(self, controls):
+        self.fps = controls.get('FrameRate', self.fps)
+
+    # Used instead of a camera reconfigure when the resolution changes.
+    def resize(self, size):
+        self.size = tuple(size)
+
+    # Sleep until the next frame is due, like a camera would.
+    def pace(self):
+        if self.fps:
+            now = time.monotonic()
+            if self.next > now:
+                time.sleep(self.next - now)
+            self.next = max(self.next, now - 1.0) + 1.0 / self.fps
+
+
+    # Convert a lores YUV420 frame to an RGB888 (BGR in memory, as
+    # Picamera2 gives it) main frame at our size.
+    def main_of(self, lores):
+        img = cv2.cvtColor(lores, cv2.COLOR_YUV2BGR_I420)
+        if img.shape[1::-1] != self.size:
+            img = cv2.resize(img, self.size)
+        return img
+
+    def lores_of(self, lores):
+        h = lores.shape[0] * 2 // 3
+        if (lores.shape[1], h) != self.size:
+            lores = cv2.cvtColor(cv2.resize(self.main_of(lores), self.size), cv2.COLOR_BGR2YUV_I420)
+        return lores
+
+
+# Plays back recorder segments (a segment dir, or a dir of them) or a
+# synth.py output dir, looping at the end.
+class ReplaySource(Source):
+    def __init__(self, path, size, fps=0, loop=True):
+        super().__init__(size, fps)
+        path = Path(path)
+        self.loop = loop
+        if (path / 'index.npy').exists():
+            self.paths = [path]
+        else:
+            self.paths = recorder.segments(path) or [path]
+        self.main = None
+        self.seg = -1
+        self.i = 0
+        self.load(0)
+
+    def load(self, num):
+        self.seg = num % len(self.paths)
+        path = self.paths[self.seg]
+        if (path / 'index.npy').exists():
+            self.lores, _, self.index = recorder.open_segment(path)
+            self.main = None
+        else:
+            self.lores = np.load(path / 'lores.npy', mmap_mode='r')
+            self.main = np.load(path / 'main.npy', mmap_mode='r')
+        self.i = 0
+        self.log.info('replaying %s (%d frames)', path, len(self.lores))
+
+    def capture_arrays(self, names=('main', 'lores'), wait=None):
+        self.pace()
+        if self.i >= len(self.lores):
+            if not self.loop and self.seg == len(self.paths) - 1:
+                raise EOFError('end of replay')
+            self.load(self.seg + 1)
+
+        i = self.i
+        self.i += 1
+        lores = np.ascontiguousarray(self.lores[i])
+        arrays = dict(lores=self.lores_of(lores))
+        if 'main' in names:
+            if self.main is not None and self.main.shape[2:0:-1] == self.size:
+                arrays['main'] = np.array(self.main[i])
+            else:
+                arrays['main'] = self.main_of(lores)
+
+        if self.encoder:
+            if self.encode not in arrays:
+                arrays['main'] = self.main_of(lores)
+            self.encoder.feed(arrays[self.encode])
+        return [arrays[x] for x in names], dict(SensorTimestamp=time.monotonic_ns())
+
+
+# A replay whose frames stop coming after a while and never resume until
+# it's reopened, like a camera after a cable glitch.  For testing the
+# stall recovery (--replay DIR --stall SECONDS).
+class StallingSource(ReplaySource):
+    def __init__(self, path, size, fps=0, every=5.0):
+        super().__init__(path, size, fps)
+        self.every = every
+        self.started = None
+        self.stalled = False
+
+    def start(self):
+        super().start()
+        self.started = time.monotonic()
+
+    def wait(self, job, timeout=None):
+        if time.monotonic() - self.started < self.every:
+            return job
+        if not self.stalled:
+            self.stalled = True
+            self.log.warning('stalling after %.1fs', self.every)
+        time.sleep(1e9 if timeout is None else timeout)
+        raise TimeoutError('no frame')
+
+
+# EOF
@@ -0,0 +1,95 @@
+# Startup timeline.
+#
+# Each init step (NT, web server, camera, detector...) records when it
+# started and finished, relative to this module's import, which main.py
+# does first thing.  Steps run concurrently where they can, so the
+# timeline shows what's actually on the critical path to the first
+# frame.  Reported once in the log and always available at /metrics.
+
+import contextlib
+import logging
+import threading
+import time
+
+T0 = time.monotonic()
+
+try:
+    # how long after power-up we got going, e.g. after a brownout reboot
+    BOOT = time.clock_gettime(time.CLOCK_BOOTTIME) - (time.monotonic() - T0)
+except AttributeError:
+    BOOT = None
+
+
+class Timeline:
+    def __init__(self):
+        self.log = logging.getLogger('startup')
+        self.steps = {}     # name: (start, end) in seconds since T0, end None if running
+        self.lock = threading.Lock()
+        self.reported = False
+
+    def now(self):
+        return time.monotonic() - T0
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = self.now()
+        with self.lock:
+            self.steps[name] = (start, None)
+        try:
+            yield
+        finally:
+            end = self.now()
+            with self.lock:
+                self.steps[name] = (start, end)
+            self.log.debug('%s done in %.3fs', name, end - start)
+
+    # A point event, like the first frame.  Only the first one counts.
+    def mark(self, name):
+        with self.lock:
+            if name not in self.steps:
+                t = self.now()
+                self.steps[name] = (t, t)
+
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        with self.lock:
+            steps = sorted(self.steps.items(), key=lambda x: x[1][0])
+        lines = [f'{name:>12} {start:6.3f} -> {"..." if end is None else f"{end:6.3f}"}'
+            for (name, (start, end)) in steps]
+        self.log.info('startup timeline (s since start%s):\n%s',
+            f', started {BOOT:.1f}s after boot' if BOOT is not None else '',
+            '\n'.join(lines))
+
+
+    # Prometheus text format.
+    def metrics(self):
+        lines = [
+            '# HELP startup_step_start_seconds Startup step start, seconds since process start.',
+            '# TYPE startup_step_start_seconds gauge',
+            ]
+        with self.lock:
+            steps = list(self.steps.items())
+        lines += [f'startup_step_start_seconds{{step="{name}"}} {start:.4f}'
+            for (name, (start, _end)) in steps]
+        lines += [
+            '# HELP startup_step_end_seconds Startup step end, seconds since process start.',
+            '# TYPE startup_step_end_seconds gauge',
+            ]
+        lines += [f'startup_step_end_seconds{{step="{name}"}} {end:.4f}'
+            for (name, (_start, end)) in steps if end is not None]
+        if BOOT is not None:
+            lines += [
+                '# HELP startup_boot_seconds Seconds from boot to process start.',
+                '# TYPE startup_boot_seconds gauge',
+                f'startup_boot_seconds {BOOT:.3f}',
+                ]
+        return '\n'.join(lines) + '\n'
+
+
+timeline = Timeline()
+
+
+# EOF
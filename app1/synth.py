@@ -0,0 +1,257 @@
+# Synthetic scene generator, to exercise the pipeline off-robot.
+#
+# Renders tag36h11 tags and orange rings under random perspective, blur,
+# noise and lighting, with ground truth, and writes them as memory-mappable
+# .npy stacks in the layouts Picamera2's capture_array() gives us:
+#   main.npy    (N, H, W, 3) uint8, "RGB888" (which is BGR in memory)
+#   lores.npy   (N, H*3/2, W) uint8, YUV420 (I420) planes stacked
+#   truth.json  sizes, seed, and per-frame tags/rings
+#
+# Tag bitmaps come from OpenCV's copy of the AprilTag tag36h11 family,
+# which is the same code list (and ids) AprilTagDetector.addFamily uses.
+#
+# Usage: python -m app1.synth -n 2000 -r 640x480 /tmp/synth
+#
+# Reading back: main, lores, truth = synth.load('/tmp/synth')
+
+import json
+import logging
+from pathlib import Path
+import time
+
+import cv2
+import numpy as np
+
+from .vision import LOWER, UPPER
+
+slog = logging.getLogger('synth')
+
+FAMILY = 'tag36h11'
+TAG_IDS = range(1, 17)  # 2024 Crescendo field tags
+CELL = 12               # pixels per tag bit in the reference bitmaps
+NOISE_BANK = 8          # precomputed noise frames, picked at random per frame
+LIGHT_STRIPS = 16       # vertical strips approximating the lighting gradient
+
+
+def tag_bitmap(tid):
+    # 8x8 cells (6x6 data + black border) plus a 1-cell white quiet zone
+    aruco = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    img = cv2.aruco.generateImageMarker(aruco, tid, 8 * CELL, borderBits=1)
+    return cv2.copyMakeBorder(img, CELL, CELL, CELL, CELL, cv2.BORDER_CONSTANT, value=255)
+
+
+class Scene:
+    def __init__(self, size=(640, 480), lores=None, seed=0, max_tags=3, max_rings=2,
+            noise_bank=NOISE_BANK):
+        self.size = tuple(size)
+        self.lores = tuple(lores or size)
+        self.seed = seed
+        self.max_tags = max_tags
+        self.max_rings = max_rings
+        self.rng = np.random.default_rng(seed)
+
+        self.tags = {tid: cv2.cvtColor(tag_bitmap(tid), cv2.COLOR_GRAY2BGR) for tid in TAG_IDS}
+        n = self.tags[TAG_IDS[0]].shape[0]
+        self.tag_src = np.float32([[0, 0], [n, 0], [n, n], [0, n]])
+        # black square corners in the detector's order: TR, TL, BL, BR
+        a, b = CELL, n - CELL
+        self.tag_corners = np.float32([[b, a], [a, a], [a, b], [b, b]])
+
+        w, h = self.size
+        # extra rows so each frame can take a randomly offset view
+        self.noise = self.rng.normal(0, 3.0, (noise_bank, h + 64, w, 3)).astype(np.int16)
+        self.strips = np.linspace(0, w, LIGHT_STRIPS + 1).astype(int)
+
+
+    # Pick an array value whose RGB2HSV conversion (what Processor.do_frame
+    # does to the main capture) lands inside LOWER/UPPER, with headroom so
+    # the frame's lighting gain range can't push it out.
+    def ring_color(self, gmin, gmax):
+        hue = self.rng.integers(LOWER[0] + 1, UPPER[0])
+        sat = self.rng.integers(max(LOWER[1] + 20, 200), UPPER[1] + 1)
+        vlo = min(255, int(np.ceil((LOWER[2] + 8) / gmin)))
+        vhi = max(vlo, min(255, int(UPPER[2] / gmax)))
+        val = self.rng.integers(vlo, vhi + 1)
+        hsv = np.uint8([[[hue, sat, val]]])
+        return tuple(int(x) for x in cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)[0, 0])
+
+
+    def background(self):
+        w, h = self.size
+        rng = self.rng
+        base = rng.integers(40, 170, (h // 40 + 2, w // 40 + 2, 1), dtype=np.int16)
+        base = (base + rng.integers(-12, 13, 3)).astype(np.uint8)  # tint
+        img = cv2.resize(base, (w, h), interpolation=cv2.INTER_CUBIC)
+
+        # a darker floor band, roughly where rings sit
+        fy = int(h * rng.uniform(0.45, 0.65))
+        cv2.convertScaleAbs(img[fy:], dst=img[fy:], alpha=rng.uniform(0.5, 0.8))
+        return img
+
+
+    # Axis-aligned boxes already drawn this frame, so objects never overlap
+    # and the ground truth stays exact.
+    def place(self, box):
+        x, y, w, h = box
+        for (px, py, pw, ph) in self.placed:
+            if x < px + pw and px < x + w and y < py + ph and py < y + h:
+                return False
+        self.placed.append(box)
+        return True
+
+
+    def add_tag(self, img, tid, tries=10):
+        w, h = self.size
+        rng = self.rng
+        for _ in range(tries):
+            s = rng.uniform(0.08, 0.35) * h
+            cx, cy = rng.uniform(s, w - s), rng.uniform(s, h - s)
+            ang = rng.uniform(-0.5, 0.5)
+            c, sn = np.cos(ang), np.sin(ang)
+            sq = np.float32([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * (s / 2)
+            dst = sq @ np.float32([[c, sn], [-sn, c]])
+            dst += rng.uniform(-0.15, 0.15, (4, 2)) * s    # perspective
+            dst += (cx, cy)
+
+            # warp only into the destination's bounding box
+            x0, y0 = np.floor(dst.min(axis=0)).astype(int)
+            x1, y1 = np.ceil(dst.max(axis=0)).astype(int) + 1
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+            if self.place((x0, y0, x1 - x0, y1 - y0)):
+                break
+        else:
+            return None
+
+        M = cv2.getPerspectiveTransform(self.tag_src, (dst - (x0, y0)).astype(np.float32))
+        size = (x1 - x0, y1 - y0)
+        patch = cv2.warpPerspective(self.tags[tid], M, size, flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(np.full(self.tags[tid].shape[:2], 255, np.uint8), M, size)
+        roi = img[y0:y1, x0:x1]
+        np.copyto(roi, patch, where=(mask > 127)[:, :, None])
+
+        corners = cv2.perspectiveTransform(self.tag_corners[None], M)[0] + (x0, y0)
+        center = cv2.perspectiveTransform(self.tag_corners.mean(axis=0)[None, None], M)[0, 0] + (x0, y0)
+        return dict(id=int(tid), corners=corners.round(2).tolist(), center=center.round(2).tolist())
+
+
+    def add_ring(self, img, color, tries=10):
+        w, h = self.size
+        rng = self.rng
+        for _ in range(tries):
+            rx = rng.uniform(0.04, 0.2) * w
+            ry = rx * rng.uniform(0.25, 0.6)    # lying on the floor
+            cx = rng.uniform(rx, w - rx)
+            cy = rng.uniform(h * 0.55, h - ry)
+            thick = max(2, int(rx * rng.uniform(0.15, 0.3)))
+            center, axes = (int(cx), int(cy)), (int(rx), int(ry))
+            pts = cv2.ellipse2Poly(center, (axes[0] + thick // 2, axes[1] + thick // 2), 0, 0, 360, 5)
+            x, y, bw, bh = cv2.boundingRect(pts)
+            box = (max(x, 0), max(y, 0), min(x + bw, w) - max(x, 0), min(y + bh, h) - max(y, 0))
+            if self.place(box):
+                break
+        else:
+            return None
+
+        cv2.ellipse(img, center, axes, 0, 0, 360, color, thick, cv2.LINE_AA)
+        return dict(box=list(box), center=list(center), axes=list(axes))
+
+
+    def render(self):
+        rng = self.rng
+        w, h = self.size
+        img = self.background()
+        self.placed = []
+
+        # lighting: overall gain plus a left/right gradient
+        g0 = rng.uniform(0.8, 1.2)
+        slope = rng.uniform(-0.1, 0.1)
+        gmin, gmax = g0 * (1 - abs(slope)), g0 * (1 + abs(slope))
+
+        rings = [self.add_ring(img, self.ring_color(gmin, gmax))
+            for _ in range(rng.integers(0, self.max_rings + 1))]
+        tags = [self.add_tag(img, tid)
+            for tid in rng.choice(list(TAG_IDS), rng.integers(0, self.max_tags + 1), replace=False)]
+        rings = [x for x in rings if x]
+        tags = [x for x in tags if x]
+
+        for x0, x1, r in zip(self.strips, self.strips[1:], np.linspace(-1, 1, LIGHT_STRIPS)):
+            cv2.convertScaleAbs(img[:, x0:x1], dst=img[:, x0:x1], alpha=g0 * (1 + slope * r))
+
+        k = int(rng.choice([1, 1, 3, 5]))
+        if k > 1:
+            img = cv2.GaussianBlur(img, (k, k), 0)
+
+        y = rng.integers(64)
+        img = cv2.add(img, self.noise[rng.integers(len(self.noise)), y:y + h], dtype=cv2.CV_8U)
+
+        return img, dict(tags=tags, rings=rings, gain=round(g0, 3), blur=k)
+
+
+    def lores_of(self, img):
+        if self.lores != self.size:
+            img = cv2.resize(img, self.lores, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+
+
+    # Yields (main, lores, truth) in memory, e.g. for warm-up or benchmarks.
+    def frames(self, n):
+        for _ in range(n):
+            img, truth = self.render()
+            yield img, self.lores_of(img), truth
+
+
+    def generate(self, path, n):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        w, h = self.size
+        lw, lh = self.lores
+        main = np.lib.format.open_memmap(path / 'main.npy', 'w+', np.uint8, (n, h, w, 3))
+        lores = np.lib.format.open_memmap(path / 'lores.npy', 'w+', np.uint8, (n, lh * 3 // 2, lw))
+
+        t0 = time.monotonic()
+        truth = []
+        for i, (imain, ilores, t) in enumerate(self.frames(n)):
+            main[i] = imain
+            lores[i] = ilores
+            truth.append(t)
+
+        main.flush()
+        lores.flush()
+        meta = dict(family=FAMILY, size=self.size, lores=self.lores, seed=self.seed, frames=truth)
+        (path / 'truth.json').write_text(json.dumps(meta))
+        elapsed = time.monotonic() - t0
+        slog.info('%d frames in %.2fs (%.0f/s) to %s', n, elapsed, n / elapsed, path)
+
+
+def load(path):
+    path = Path(path)
+    main = np.load(path / 'main.npy', mmap_mode='r')
+    lores = np.load(path / 'lores.npy', mmap_mode='r')
+    truth = json.loads((path / 'truth.json').read_text())
+    return main, lores, truth
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    parser.add_argument('-r', '--res', default='640x480')
+    parser.add_argument('--lores', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tags', type=int, default=3)
+    parser.add_argument('--rings', type=int, default=2)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    size = tuple(int(x) for x in args.res.split('x'))
+    lores = tuple(int(x) for x in args.lores.split('x')) if args.lores else None
+    scene = Scene(size, lores, seed=args.seed, max_tags=args.tags, max_rings=args.rings)
+    scene.generate(args.path, args.count)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
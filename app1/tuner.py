@@ -0,0 +1,137 @@
+# Runtime AprilTag detector autotuner.
+#
+# Watches per-frame processing time and the tags' decision margins, and
+# adjusts the detector config (quadDecimate, numThreads, decodeSharpening)
+# to hold a target frame rate while keeping as much detection range as
+# the CPU can afford right now: the lowest decimation that fits the budget.
+#
+# Decisions are logged (logger 'tune') and sent to the UI as 'tune' msgs.
+
+import logging
+import os
+
+# Decimation steps, best range first.  Each step down the list is cheaper
+# but loses small (distant) tags.
+LADDER = [1.0, 1.5, 2.0, 3.0, 4.0]
+
+OVER = 0.9          # fraction of frame budget above which we're too slow
+UNDER = 0.55        # ... and below which there's room for more range
+MARGIN_LOW = 40     # median decision margin below which we sharpen more
+MARGIN_HIGH = 120   # ... and above which we back off sharpening
+SHARP_RANGE = (0.0, 0.5)    # margin jumps a lot with 1.0
+
+
+class Tuner:
+    def __init__(self, det, target, sender, cam=0, period=1.0, hold=3.0):
+        self.det = det
+        self.target = target
+        self.budget = 1.0 / target
+        self.send = sender
+        self.cam = cam
+        self.period = period    # seconds per evaluation window
+        self.hold = hold        # min seconds between changes
+        self.log = logging.getLogger('tune')
+
+        self.sync()
+        self.max_threads = max(os.cpu_count() or 1, self.threads)
+
+        # After a step toward more range overloads us, don't retry it
+        # until the backoff (doubled each failure) has expired.
+        self.backoff = {}
+
+        self.changed = 0
+        self.start = None
+        self.reset()
+
+
+    # (Re)load our state from the detector, e.g. after a live config change.
+    def sync(self):
+        cfg = self.det.getConfig()
+        self.level = min(range(len(LADDER)), key=lambda i: abs(LADDER[i] - cfg.quadDecimate))
+        self.threads = cfg.numThreads
+        self.sharpening = cfg.decodeSharpening
+
+
+    def reset(self, now=None):
+        self.start = now
+        self.frames = 0
+        self.work = 0.0
+        self.margins = []
+
+
+    # Called once per frame from the vision thread, with the processing
+    # time (capture excluded) and the detections.
+    def update(self, now, work, tags):
+        if self.start is None:
+            self.reset(now)
+            return
+
+        self.frames += 1
+        self.work += work
+        self.margins.extend(t.getDecisionMargin() for t in tags)
+
+        if now - self.start >= self.period:
+            self.evaluate(now)
+            self.reset(now)
+
+
+    def evaluate(self, now):
+        fps = self.frames / (now - self.start)
+        load = (self.work / self.frames) / self.budget
+        margins = sorted(self.margins)
+        margin = margins[len(margins) // 2] if margins else None
+
+        level, threads, sharp = self.level, self.threads, self.sharpening
+        reason = None
+
+        if now - self.changed < self.hold:
+            pass
+        elif load > OVER and fps < self.target * 0.95:
+            if threads < self.max_threads:
+                threads += 1
+                reason = 'slow: more threads'
+            elif level < len(LADDER) - 1:
+                # the level we're leaving was too expensive, back off retrying it
+                self.backoff[level] = (now, 2 * self.backoff.get(level, (0, self.hold * 5))[1])
+                level += 1
+                reason = 'slow: more decimation'
+        elif load < UNDER and level > 0 and self.may_retry(level - 1, now):
+            level -= 1
+            reason = 'headroom: less decimation'
+
+        # Margins only matter once the frame rate is settled.
+        elif margin is not None:
+            if margin < MARGIN_LOW and sharp < SHARP_RANGE[1]:
+                sharp = min(SHARP_RANGE[1], sharp + 0.05)
+                reason = 'low margin: sharpen'
+            elif margin > MARGIN_HIGH and sharp > SHARP_RANGE[0]:
+                sharp = max(SHARP_RANGE[0], sharp - 0.05)
+                reason = 'high margin: soften'
+
+        if reason:
+            self.apply(now, level, threads, sharp)
+            self.log.info('%s: dec=%s threads=%s sharp=%.2f (fps=%.1f load=%.2f margin=%s)',
+                reason, LADDER[level], threads, sharp, fps, load, margin)
+
+        self.send('tune', cam=self.cam, dec=LADDER[self.level], threads=self.threads,
+            sharp=round(self.sharpening, 2), fps=round(fps, 1), load=round(load, 2),
+            margin=margin and round(margin), reason=reason)
+
+
+    def may_retry(self, level, now):
+        since, wait = self.backoff.get(level, (0, 0))
+        return now - since >= wait
+
+
+    def apply(self, now, level, threads, sharp):
+        cfg = self.det.getConfig()
+        cfg.quadDecimate = LADDER[level]
+        cfg.numThreads = threads
+        cfg.decodeSharpening = sharp
+        self.det.setConfig(cfg)
+
+        self.level, self.threads, self.sharpening = level, threads, sharp
+        self.changed = now
+
+
+# EOF
@@ -0,0 +1,149 @@
+# UDP detection side channel.
+#
+# Sends one fixed-size datagram per frame to the robot controller as soon
+# as that frame's detections are done, without NT's batching.  Everything
+# is little-endian:
+#
+#   header  magic 'RMCV', version, cam, ntags, flags (see FLAG_*),
+#           seq (u32), capture time, send time (i64 ns, the Pi's
+#           time.monotonic_ns(), capture being the sensor's timestamp for
+#           the frame's first line)
+#           ring x, y, w, h (i16, zero if none)
+#   tags    MAX_TAGS x (id i16, margin f32, center x, y f32), best first;
+#           unused slots have id -1
+#
+# Positions are in pixels, undistorted if there's a lens calibration (see
+# calib.py).
+#
+# Both times come from the same clock, so the receiver can tell how old a
+# detection was when it left, and can spot drops from gaps in seq.  The
+# scheduler doesn't run every detector every frame, so flags also say
+# which ones ran: no tags with FLAG_TAGS clear means "didn't look".
+#
+# Reference receiver, e.g. against a local stand-in:
+#   python -m app1.udp --listen 5800
+#   python -m app1.main --udp 127.0.0.1:5800 ...
+
+import logging
+import socket
+import struct
+import time
+
+MAGIC = b'RMCV'
+VERSION = 1
+MAX_TAGS = 8
+
+HEADER = struct.Struct('<4sBBBBIqq4h')
+TAG = struct.Struct('<hfff')
+SIZE = HEADER.size + MAX_TAGS * TAG.size
+
+FLAG_RING = 1       # ring found
+FLAG_READY = 2      # vision warmed up
+FLAG_TAGS = 4       # tag detector ran this frame
+FLAG_RINGS = 8      # ring detector ran this frame
+
+EMPTY_TAG = TAG.pack(-1, 0, 0, 0)
+
+
+def parse_addr(addr):
+    host, _, port = addr.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+class Publisher:
+    def __init__(self, addr, cam=0):
+        self.log = logging.getLogger('udp')
+        self.addr = parse_addr(addr)
+        self.cam = cam
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.buf = bytearray(SIZE)
+        self.sent = 0
+        self.errors = 0
+        self.log.info('sending detections to %s:%d', *self.addr)
+
+    # Never blocks or raises: a full socket buffer or nobody listening
+    # just costs the datagram.
+    # points: per tag, (corners..., centre) as from Processor.locate()
+    def send(self, seq, t_capture, tags, points, ring, jobs, ready=True):
+        best = sorted(range(len(tags)), key=lambda k: -tags[k].getDecisionMargin())[:MAX_TAGS]
+        flags = ((FLAG_RING if ring else 0) | (FLAG_READY if ready else 0)
+            | (FLAG_TAGS if 'tag' in jobs else 0) | (FLAG_RINGS if 'ring' in jobs else 0))
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, self.cam, len(best), flags,
+            seq & 0xffffffff, t_capture, time.monotonic_ns(), *(ring or (0, 0, 0, 0)))
+        offset = HEADER.size
+        for k in best:
+            (x, y) = points[k, 4]
+            TAG.pack_into(self.buf, offset, tags[k].getId(), tags[k].getDecisionMargin(), x, y)
+            offset += TAG.size
+        self.buf[offset:] = EMPTY_TAG * (MAX_TAGS - len(best))
+
+        try:
+            self.sock.sendto(self.buf, self.addr)
+            self.sent += 1
+        except OSError as ex:
+            if not self.errors:
+                self.log.warning('send failed: %s', ex)
+            self.errors += 1
+
+    def close(self):
+        self.sock.close()
+
+
+def decode(data):
+    if len(data) != SIZE:
+        raise ValueError(f'bad size {len(data)}')
+    (magic, version, cam, ntags, flags, seq, t_capture, t_sent, *ring) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'bad header {magic!r} v{version}')
+    tags = [TAG.unpack_from(data, HEADER.size + i * TAG.size) for i in range(ntags)]
+    return dict(cam=cam, seq=seq, flags=flags, t_capture=t_capture, t_sent=t_sent,
+        ring=tuple(ring) if flags & FLAG_RING else None,
+        tags=[dict(id=i, margin=m, x=x, y=y) for (i, m, x, y) in tags])
+
+
+def listen(port, host=''):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    print(f'listening on {host or "*"}:{port}')
+    last = None
+    lost = 0
+    while True:
+        data, addr = sock.recvfrom(2048)
+        t_recv = time.monotonic_ns()
+        try:
+            msg = decode(data)
+        except ValueError as ex:
+            print(f'{addr}: {ex}')
+            continue
+
+        if last is not None and msg['seq'] != last + 1:
+            lost += max(0, msg['seq'] - last - 1)
+        last = msg['seq']
+        # t_recv is only comparable to the Pi's clock on the same host
+        best = msg['tags'][0] if msg['tags'] else None
+        print(f"#{msg['seq']} age {(msg['t_sent'] - msg['t_capture']) / 1e6:5.1f}ms"
+            f" (+{(t_recv - msg['t_sent']) / 1e6:.2f}ms if local)"
+            f" tags {len(msg['tags'])}"
+            + (f" best id={best['id']} @{best['x']:.0f},{best['y']:.0f}" if best else '')
+            + (f" ring {msg['ring']}" if msg['ring'] else '')
+            + (f' lost {lost}' if lost else ''))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listen', type=int, default=5800)
+    parser.add_argument('--host', default='')
+    args = parser.parse_args()
+    try:
+        listen(args.listen, args.host)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
+
+
+# EOF
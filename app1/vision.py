@@ -1,10 +1,13 @@
 import asyncio
+import bisect
+import importlib.util
 import io
 import itertools
 import json
 import logging
 import os
 from pathlib import Path
+import queue
 import re
 import signal
 import sys
@@ -13,25 +16,28 @@ import time
 import traceback
 import weakref
 
-import robotpy_apriltag as at
+from aiohttp import web
 
 import cv2
 import numpy as np
 
+from . import calib, detections, logs, looplag, passthru, renditions, sources
+from .handoff import Handoff
 from .utils import log_uncaught
 from .net_tables import NT
+from .recorder import Recorder
+from .sched import Scheduler
+from .startup import timeline
+from .tuner import Tuner
+from .udp import Publisher
 
 logging.getLogger('picamera2').setLevel(logging.INFO)
 
 vlog = logging.getLogger('vision')
 
-try:
-    import libcamera
-    from picamera2 import Picamera2
-    from picamera2.encoders import MJPEGEncoder
-    from picamera2.outputs import FileOutput
-except ImportError:
-    pass
+# picamera2 (slow to import) and robotpy_apriltag are imported by
+# open_camera() and make_detector(), which run concurrently at startup.
+libcamera = Picamera2 = at = None
 
 # This is NOT how anyone should do this. Just a hack for a quick "singleton".
 class output:
@@ -39,9 +45,20 @@ class output:
     ready = None
     frame = None
     count = 0
-
-
+    pending = queue.SimpleQueue()   # config updates, applied between frames
+    latest = None   # (seq, jpeg, lores) from the last frame, for snapshots
+    shown = None    # (seq, jpeg, image drawn on), for stream renditions
+    warm = False    # warmed up and delivering frames, see Processor.warm_up()
+    handoff = None  # Processor's, for /metrics
+    det = None      # Processor's, for current_config()
+    seq = 0         # last frame captured, for the watchdog
+    stalls = 0      # camera stalls, see Processor.recover()
+    recoveries = 0
+
+
+# Query options (fps, scale, q, auto) are in renditions.Viewer.
 async def stream1(request):
+    viewer = renditions.Viewer(request.query, args.fps)
     response = web.StreamResponse(
         status=200,
         reason='OK',
@@ -53,17 +70,24 @@ async def stream1(request):
         )
     # breakpoint()
     await response.prepare(request)
+    viewer.attach(request.transport)
 
     try:
         while output.running:
             await output.ready.wait()
             output.ready.clear()
-            frame = output.frame
-            await response.write(b'--FRAME\r\n')
-            await response.write(b'Content-Type: image/jpeg\r\n')
-            await response.write(f'Content-Length: {len(frame)}\r\n\r\n'.encode('utf-8'))
+            if not viewer.wanted(time.monotonic(), request.transport):
+                continue
+            remap = CAL.remap if viewer.undistort and not CAL.identity else None
+            frame = await renditions.renditions.get(output.shown, *viewer.rendition(), remap)
+            if not frame:
+                continue
+
+            head = f'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n'.encode('utf-8')
+            await response.write(head)
             await response.write(frame)
             await response.write(b'\r\n')
+            viewer.sent += len(head) + len(frame) + 2
 
     except Exception as e:
         pass
@@ -78,20 +102,100 @@ async def stream1(request):
         return response
 
 
+# Conditional GET support for snapshots: the ETag is the frame sequence,
+# so pollers get a bodiless 304 until there's a new frame.  seq restarts
+# at 1 every run, so a per-process token keeps a restart's frames from
+# matching a tag cached before it.
+ETAG_RUN = os.urandom(4).hex()
+def snapshot_etag(request):
+    cam = request.match_info['cam']
+    if cam and int(cam) != args.cam:
+        raise web.HTTPNotFound()
+    if not output.latest:
+        raise web.HTTPServiceUnavailable(text='no frame yet')
+
+    seq = output.latest[0]
+    etag = f'{ETAG_RUN}-{args.cam}-{seq}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if any(x.value in (etag, '*') for x in request.if_none_match or ()):
+        raise web.HTTPNotModified(headers=headers)
+    return headers
+
+
+# Latest JPEG, as already encoded for the stream.
+async def snapshot_jpg(request):
+    headers = snapshot_etag(request)
+    _seq, jpeg, _lores = output.latest
+    return web.Response(body=jpeg, content_type='image/jpeg', headers=headers)
+
+
+# Latest raw lores (YUV420) frame as a .npy, for offline tuning.
+_npy = (None, None)
+async def snapshot_npy(request):
+    global _npy
+    headers = snapshot_etag(request)
+    seq, _jpeg, lores = output.latest
+    if _npy[0] != seq:
+        buf = io.BytesIO()
+        np.save(buf, lores)
+        _npy = (seq, buf.getvalue())
+    headers['Content-Disposition'] = f'attachment; filename="cam{args.cam}-{seq}.npy"'
+    return web.Response(body=_npy[1], content_type='application/octet-stream', headers=headers)
+
+
 #-----------------------------
 
 # Define the lower and upper bounds for the orange color
 LOWER = np.array([115, 140, 180])
 UPPER = np.array([125, 255, 255])
 
+# ...and in the lores U and V planes, for --ring chroma: the box around
+# every colour in that window.  As in do_frame(), main's BGR is taken as
+# RGB.  U and V are bilinear in S and V for any one hue, so only their
+# limits need trying.
+KR_KB = {'Rec601': (0.299, 0.114), 'Rec709': (0.2126, 0.0722), 'Rec2020': (0.2627, 0.0593)}
+
+def chroma_bounds(lower, upper, yuv):
+    (encoding, limited) = yuv
+    (kr, kb) = KR_KB[encoding]
+    hsv = np.array([(h, s, v) for h in range(lower[0], upper[0] + 1)
+        for s in (lower[1], upper[1]) for v in (lower[2], upper[2])], np.uint8)
+    (b, g, r) = cv2.cvtColor(hsv[None], cv2.COLOR_HSV2RGB)[0].T / 255
+    y = kr * r + (1 - kr - kb) * g + kb * b
+    scale = 224 if limited else 255
+    u = 128 + scale * (b - y) / (2 - 2 * kb)
+    v = 128 + scale * (r - y) / (2 - 2 * kr)
+    lo = np.floor([u.min(), v.min()]).clip(0, 255)
+    hi = np.ceil([u.max(), v.max()]).clip(0, 255)
+    return (tuple(int(x) for x in lo), tuple(int(x) for x in hi))
+
+YUV = ('Rec601', True)  # lores YCbCr encoding and whether limited range, see yuv_of()
+(CHROMA_LOWER, CHROMA_UPPER) = chroma_bounds(LOWER, UPPER, YUV)
+
 FONT = cv2.FONT_HERSHEY_SIMPLEX
 
+STATUS_PERIOD = 1.0 # seconds between console status lines
+
+WARM_WINDOW = 8     # frames per window when checking warm-up has levelled off
+WARM_SPREAD = 0.15  # ...to within this fraction of the previous window
+WARM_LIMIT = 3.0    # seconds, give up and go anyway
+
+CAPTURE_TIMEOUT = 1.0   # seconds to wait for a frame before calling it a stall
+REOPEN_TIMEOUT = 5.0    # seconds allowed for each camera close or reopen
+REOPEN_RETRY = 0.5      # seconds between reopen attempts
+WATCH_PERIOD = 0.1      # seconds between watchdog checks
+STALL_AFTER = 0.5       # seconds without a frame before we're degraded
+
+MAX_RES = (4608, 2592)  # Camera Module 3's full sensor
+
 class Processor:
     def __init__(self, shutdown, det, sender, loop):
         self.shutdown = shutdown
-        self._sender = sender
         self.loop = loop
-        self.det = det
+        # everything for the loop goes out in one go at the end of a frame
+        self.handoff = output.handoff = Handoff(loop, sender, lambda: output.ready.set(),
+            detections.hub.publish)
+        self.det = output.det = det
         self.log = logging.getLogger('proc')
 
         self.reported = time.monotonic()
@@ -100,11 +204,23 @@ class Processor:
         self.found = False
         self.dist1 = None
         self.beam1 = None
+        self.tags = []
+        self.ring = None
+        self.points = None  # per tag, undistorted corners and centre, see locate()
+        self.seq = 0
+        self.cam = None
+        self.tuner = None
+        self.recorder = None
+        self.udp = None
+        self.frames = 0
+        self.work = 0.0
+        self.latency = 0    # ns, sensor timestamp to results out, summed
+        self.cpu = time.process_time()
+        self.due = 0.0      # next --pace slot
+        self.sched = Scheduler(args.sched)
 
     def send(self, msg, **kwargs):
-        def _send():
-            self._sender(msg, **kwargs)
-        self.loop.call_soon_threadsafe(_send)
+        self.handoff.send(msg, **kwargs)
 
 
     def do_frame(self, iraw):
@@ -137,6 +253,42 @@ class Processor:
         #     ncircles = 0
         #     ctext = 'none'
 
+        self.find_ring(mask)
+        imgout = iraw
+
+        # if ncircles > 0:
+        #     try:
+        #         imgout = cv2.circle(imgout, (int(cx), int(cy)), int(cr), (255, 0, 40), 15)
+        #     except Exception as ex:
+        #         # print(ex)
+        #         pass
+
+        return imgout
+
+
+    # Orange straight from the lores U and V planes: quarter the pixels of
+    # main and no colour conversion.  The planes are views into the
+    # capture, not copies.
+    def do_chroma(self, ilores):
+        (h, w) = (ilores.shape[0] * 2 // 3, ilores.shape[1])
+        u = ilores[h:h + h // 4].reshape(h // 2, w // 2)
+        v = ilores[h + h // 4:h + h // 2].reshape(h // 2, w // 2)
+        mask = cv2.inRange(u, CHROMA_LOWER[0], CHROMA_UPPER[0])
+        cv2.bitwise_and(mask, cv2.inRange(v, CHROMA_LOWER[1], CHROMA_UPPER[1]), dst=mask)
+        self.find_ring(mask, SIZE[0] / (w // 2))
+
+
+    # Headless there's no RGB main, so it's always chroma.
+    def do_ring(self, imain, ilores):
+        if args.ring == 'chroma' or imain is None:
+            self.do_chroma(ilores)
+            return imain
+        return self.do_frame(imain)
+
+
+    # Largest blob in the mask, as a box in main coordinates (the mask
+    # being scale times smaller).
+    def find_ring(self, mask, scale=1):
         # Find contours in the mask
         contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         # if contours:
@@ -147,7 +299,7 @@ class Processor:
             # Fit rectangle around contour
             box = cv2.boundingRect(contour)
             x, y, w, h = box
-            maxdim = max(w, h)
+            maxdim = max(w, h) * scale
 
             # Check if the detected object is big enough
             if maxdim >= MIN_SIZE:
@@ -155,10 +307,9 @@ class Processor:
 
         if matches:
             matches.sort()
-            _, (x, y, w, h) = matches[-1]
-
-            # outline the object
-            imgout = cv2.rectangle(iraw, (x, y), (x+w, y+h), (0, 255, 0), 2)
+            _, box = matches[-1]
+            (x, y, w, h) = (round(v * scale) for v in box)
+            self.ring = (x, y, w, h)
 
             # X position of ring center from camera center (right positive, left negative)
             ix = (x + w // 2) - CX
@@ -168,30 +319,15 @@ class Processor:
             # Print the center coordinates of the circle
             # print(f"\rring: {ix:3d},{iy:3d} {ctext:10s}        ", end='')
         else:
-            imgout = iraw
-
-        # if ncircles > 0:
-        #     try:
-        #         imgout = cv2.circle(imgout, (int(cx), int(cy)), int(cr), (255, 0, 40), 15)
-        #     except Exception as ex:
-        #         # print(ex)
-        #         pass
-
-        return imgout
+            self.ring = None
 
 
-    def do_apriltag(self, arr, imgout):
+    def do_apriltag(self, arr):
         # img = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
         img = arr[:SIZE[1],:]
         # img = arr
-        tags = self.det.detect(img)
-        self.count += 1
-        now = time.time()
-        if now - self.reported > 1:
-            elapsed = now - self.reported
-            self.send('fps', cam=args.cam, t=elapsed, n=self.count) # raw info for FPS or period
-            self.reported = now
-            self.count = 0
+        tags = self.tags = self.det.detect(img)
+        self.points = self.locate(tags)
 
         if self.found != bool(tags):
             self.found = not self.found
@@ -199,8 +335,6 @@ class Processor:
 
         if not self.found:
             self.missed += 1
-            motor = 'ON ' if NT.motor.get() else 'OFF'
-            # print(f'\r{motor} missed {self.missed}' + ' ' * 40, end='')
             # if self.missed == 25:
             #     cv2.imwrite('fail.png', img)
             #     # breakpoint()
@@ -209,66 +343,358 @@ class Processor:
             NT.tag_y.set(SIZE[1]//2)
         else:
             self.missed = 0
-            for (i, tag) in enumerate(sorted(tags, key=lambda x: x.getDecisionMargin())):
-                c = tag.getCenter()
-                x = int(c.x)
-                y = int(c.y)
-                tid = tag.getId()
-                # pose = field.getTagPose(tid)H = tag.homography
-                if i == 0:
-                    NT.tag_x.set(x)
-                    NT.tag_y.set(y)
-
-                hmat = '' # '[' + ', '.join(f'{x:.0f}' for x in x.getHomography()) + ']'
-                margin = tag.getDecisionMargin()
-                motor = 'ON ' if NT.motor.get() else 'OFF'
-                print(f'\r{motor} margin={margin:2.0f} @{c.x:3.0f},{c.y:3.0f} id={tid:2} {hmat}    ' % tags, end='')
+            # pose = field.getTagPose(tid)H = tag.homography
+            i = min(range(len(tags)), key=lambda k: tags[k].getDecisionMargin())
+            (x, y) = self.points[i, 4]
+            NT.tag_x.set(int(x))
+            NT.tag_y.set(int(y))
 
-                if args.nodraw:
-                    cv2.circle(imgout, (x, y), 5, (40, 0, 255), -1)
+            # breakpoint()
 
-                    H = tag.getHomographyMatrix()
+        return tags
 
-                    # Define the corners of the tag (assuming a 2x2 tag for simplicity)
-                    tc = np.array([[-1, -1, 1], [ 1, -1, 1], [ 1,  1, 1], [-1,  1, 1]])
 
-                    # Project the corners into the image plane
-                    ic = (H @ tc.T).T
+    # Points in the detector's convention (pixel centres at +0.5) through
+    # the lens calibration.  Only what we report is undistorted, never the
+    # image.
+    def undistort(self, pts):
+        return CAL.undistort(np.asarray(pts, np.float32) - 0.5) + 0.5
 
-                    # Normalize the points
-                    ic2 = (ic[:, :2] / ic[:, 2][:, np.newaxis]).astype(np.int32)
+    # (ntags, 5, 2): the four corners then the centre of each tag.
+    def locate(self, tags):
+        pts = [[(tag.getCorner(k).x, tag.getCorner(k).y) for k in range(4)]
+            + [(tag.getCenter().x, tag.getCenter().y)] for tag in tags]
+        return self.undistort(np.array(pts, np.float32).reshape(-1, 5, 2))
 
-                    # Draw the rectangle
-                    for i in range(4):
-                        pt1 = tuple(ic2[i % 4])
-                        pt2 = tuple(ic2[(i + 1) % 4])
-                        cv2.line(imgout, pt1, pt2, (210, 30, 150), 4)
+    # ring box (OpenCV pixels) with its corners undistorted
+    def undistort_box(self, box):
+        (x, y, w, h) = box
+        ((x0, y0), (x1, y1)) = CAL.undistort([(x, y), (x + w, y + h)])
+        return (int(round(x0)), int(round(y0)), int(round(x1 - x0)), int(round(y1 - y0)))
 
-                    cv2.putText(imgout, f'{tag.getId()}', tuple(ic2[1] + [-4, 0]), FONT, 1.2, (128, 255, 128), 3, cv2.LINE_AA)
 
-            # breakpoint()
+    # outline the ring
+    def draw_ring(self, imgout):
+        x, y, w, h = self.ring
+        cv2.rectangle(imgout, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+
+    # Kept separate from do_apriltag() since the overlay colours would
+    # show up in the ring mask if drawn before do_frame() runs.
+    def draw_tags(self, tags, imgout):
+        for tag in tags:
+            c = tag.getCenter()
+            cv2.circle(imgout, (int(c.x), int(c.y)), 5, (40, 0, 255), -1)
+
+            H = tag.getHomographyMatrix()
+
+            # Define the corners of the tag (assuming a 2x2 tag for simplicity)
+            tc = np.array([[-1, -1, 1], [ 1, -1, 1], [ 1,  1, 1], [-1,  1, 1]])
+
+            # Project the corners into the image plane
+            ic = (H @ tc.T).T
+
+            # Normalize the points
+            ic2 = (ic[:, :2] / ic[:, 2][:, np.newaxis]).astype(np.int32)
+
+            # Draw the rectangle
+            for i in range(4):
+                pt1 = tuple(ic2[i % 4])
+                pt2 = tuple(ic2[(i + 1) % 4])
+                cv2.line(imgout, pt1, pt2, (210, 30, 150), 4)
+
+            cv2.putText(imgout, f'{tag.getId()}', tuple(ic2[1] + [-4, 0]), FONT, 1.2, (128, 255, 128), 3, cv2.LINE_AA)
 
         return imgout
 
 
+    # Rate-limited console summary.  Goes through logging, so it's queued
+    # for the writer thread and never blocks us on a slow terminal.
+    def status(self, elapsed):
+        timeline.report()   # just the first time
+        frames = self.frames or 1
+        nlog, tlog = logs.handler.take()
+        motor = 'ON ' if NT.motor.get() else 'OFF'
+        if self.found:
+            tag = max(self.tags, key=lambda x: x.getDecisionMargin())
+            c = tag.getCenter()
+            seen = f'id={tag.getId():2} margin={tag.getDecisionMargin():3.0f} @{c.x:3.0f},{c.y:3.0f} ({len(self.tags)} tags)'
+        else:
+            seen = f'missed {self.missed}'
+
+        rec = self.recorder
+        cpu = time.process_time()
+        self.log.info('%s %s | %.1f fps, work %.1fms, latency %.1fms, cpu %.0f%% | loop lag %.1fms | log %d recs, %.0fus/frame, %d dropped%s',
+            motor, seen, self.frames / elapsed, self.work / frames * 1e3, self.latency / frames / 1e6,
+            (cpu - self.cpu) / elapsed * 100, looplag.monitor.take() * 1e3,
+            nlog, tlog / frames * 1e6, logs.queue.dropped,
+            f' | rec {rec.written} written, {rec.dropped} dropped' if rec else '')
+        self.frames = 0
+        self.work = 0.0
+        self.latency = 0
+        self.cpu = cpu
+
+
+    # Put synthetic frames through the whole pipeline until per-frame time
+    # levels off, so the first real frames don't pay for the detector's
+    # thread pool spin-up, first-call allocations in OpenCV, JPEG encoder
+    # tables and page faults on fresh buffers.  NT and the UI see none of
+    # it.  The camera is already running, so its AE/AWB settle meanwhile.
+    def warm_up(self, scene):
+        t0 = time.monotonic()
+        times = []
+        for (imain, ilores, _truth) in scene.frames(1000):
+            t1 = time.monotonic()
+            out = self.do_ring(None if args.headless else imain, ilores)
+            tags = self.det.detect(ilores[:SIZE[1],:])
+            if not args.headless:
+                if self.ring:
+                    self.draw_ring(out)
+                if args.nodraw:
+                    self.draw_tags(tags, out)
+                cv2.imencode('.jpg', out)
+            times.append(time.monotonic() - t1)
+
+            if len(times) >= 2 * WARM_WINDOW:
+                last = np.median(times[-WARM_WINDOW:])
+                prev = np.median(times[-2 * WARM_WINDOW:-WARM_WINDOW])
+                if abs(last - prev) <= WARM_SPREAD * prev:
+                    break
+            if t1 - t0 > WARM_LIMIT:
+                self.log.warning('warm-up never levelled off')
+                break
+
+        self.ring = None
+        self.log.info('warm-up: %d frames in %.2fs, first %.1fms, now %.1fms/frame',
+            len(times), time.monotonic() - t0, times[0] * 1e3, np.median(times[-WARM_WINDOW:]) * 1e3)
+
+
+    def set_ready(self):
+        output.warm = True
+        NT.set_ready(True)
+        timeline.mark('ready')
+        self.send('ready', cam=args.cam, data=True)
+
+
+    def tally(self):
+        self.count += 1
+        self.frames += 1
+        now = time.time()
+        if now - self.reported > 1:
+            elapsed = now - self.reported
+            self.send('fps', cam=args.cam, t=elapsed, n=self.count) # raw info for FPS or period
+            self.reported = now
+            self.count = 0
+
+
+    # Apply an update built by prepare_config(), between frames.  All or
+    # nothing: if any part fails, whatever it changed goes back as it was
+    # and the UI gets the error with the (old) settings.
+    def reconfigure(self, cam, update):
+        t0 = time.monotonic()
+        undo = self.undo_for(update)
+        try:
+            self.apply(cam, update)
+        except Exception as ex:
+            self.log.exception('reconfigure %s failed, restoring', sorted(update['args']))
+            try:
+                self.apply(cam, undo)
+            except Exception:
+                # the camera may be left stopped, which recover() sees to
+                self.log.exception('restoring failed')
+            self.send('config', error=str(ex), **current_config())
+            return
+
+        self.log.info('reconfigured %s in %.3fs', sorted(update['args']), time.monotonic() - t0)
+        self.send('config', **current_config())
+
+    # An update that puts back everything update would change.
+    def undo_for(self, update):
+        undo = dict(args={key: getattr(args, key) for key in update['args']},
+            lower=LOWER, upper=UPPER)
+        if 'geometry' in update:
+            undo['geometry'] = (SIZE, MIN_SIZE, CX, CY, CAL)
+        if 'detector' in update:
+            cfg = self.det.getConfig()
+            undo['detector'] = {key: getattr(cfg, key) for key in update['detector']}
+        return undo
+
+    def apply(self, cam, update):
+        global LOWER, UPPER, SIZE, MIN_SIZE, CX, CY, CAL
+        for key, val in update['args'].items():
+            setattr(args, key, val)
+
+        LOWER = update.get('lower', LOWER)
+        UPPER = update.get('upper', UPPER)
+        set_chroma()
+
+        if 'geometry' in update:
+            SIZE, MIN_SIZE, CX, CY, CAL = update['geometry']
+            if isinstance(cam, sources.Source):
+                cam.resize(SIZE)
+        if ('geometry' in update or 'headless' in update['args']) and not isinstance(cam, sources.Source):
+            # Only a size or stream change needs the camera reconfigured,
+            # but we can do it without closing it or touching the detector.
+            passthru.stop(cam)
+            cam.stop()
+            cam.configure(cam_config(cam))
+            start_camera(cam, self.loop)
+        elif 'fps' in update['args']:
+            cam.set_controls(dict(FrameRate=args.fps))
+
+        if 'detector' in update:
+            cfg = self.det.getConfig()
+            for key, val in update['detector'].items():
+                setattr(cfg, key, val)
+            self.det.setConfig(cfg)
+            if self.tuner:
+                self.tuner.sync()
+
+        if 'headless' in update['args'] or 'fps' in update['args']:
+            self.retune()
+
+
+    # The tuner runs with --tune, and also headless (at the frame rate, so
+    # what's saved on drawing and encoding goes on range).  When it stops,
+    # the detector goes back to how make_detector() set it up.
+    def retune(self):
+        target = args.tune or (args.fps if args.headless else 0)
+        if self.tuner and self.tuner.target == target:
+            return
+        if target:
+            self.tuner = Tuner(self.det, target, self.send, cam=args.cam)
+            self.log.info('tuning for %.0f fps', target)
+        elif self.tuner:
+            self.tuner = None
+            self.det.setConfig(base_config(self.det.getConfig()))
+            self.send('tune', cam=args.cam)
+            self.log.info('tuning off')
+
+
+    # The camera's stopped delivering.  Close it and open it again, leaving
+    # everything else (detector, buffers, web server) as it is.  Each step
+    # is bounded, and it keeps trying until it works or we're shut down.
+    def recover(self, cam):
+        output.stalls += 1
+        self.log.warning('camera stalled (%d so far), reopening', output.stalls)
+        t0 = time.monotonic()
+        try:
+            bounded(REOPEN_TIMEOUT, close_camera, cam)
+        except Exception as ex:
+            self.log.warning('close failed: %s', ex)
+
+        while not self.shutdown.is_set():
+            try:
+                # a camera opened too late to use must still be closed, or
+                # it stays claimed and every later attempt fails
+                cam = bounded(REOPEN_TIMEOUT, reopen_camera, self.loop, cleanup=close_camera)
+            except Exception as ex:
+                self.log.warning('reopen failed: %s', ex)
+                time.sleep(REOPEN_RETRY)
+                continue
+            output.recoveries += 1
+            self.log.info('camera back in %.2fs', time.monotonic() - t0)
+            break
+        self.cam = cam
+        return cam
+
+
+    # With --pace, process frames at that rate rather than every one the
+    # camera delivers: sleep until the next slot, then take the next frame
+    # to arrive, so it's still fresh.  Slots stay on a fixed grid, so time
+    # spent on a frame doesn't add up as drift, unless we fall a whole
+    # period behind, when the grid restarts from now.
+    def pace(self):
+        period = 1.0 / args.pace
+        now = time.monotonic()
+        if self.due > now:
+            self.shutdown.wait(self.due - now)
+        self.due = max(self.due, now - period) + period
+
+
     def run(self, cam):
+        self.cam = cam
         base = time.monotonic()
         done = self.shutdown.is_set # local var for faster access
+        pending = output.pending
         while not done():
-            # time.sleep(0.005)
+            if not pending.empty():
+                self.reconfigure(cam, pending.get_nowait())
+
+            if args.pace:
+                self.pace()
             # runs every 33ms with camera module v3 at 640x480 or 1024x768
             t0 = time.monotonic()
-            imain = cam.capture_array('main')
-            ilores = cam.capture_array('lores')
+            # both from the same request, unlike two capture_array() calls;
+            # wait() sleeps until the camera signals the request's done
+            try:
+                job = cam.capture_arrays(capture_names(cam), wait=False)
+                arrays, meta = cam.wait(job, timeout=CAPTURE_TIMEOUT)
+            except TimeoutError:
+                if not done():
+                    cam = self.recover(cam)
+                continue
             t1 = time.monotonic()
-            out = self.do_frame(imain)
-            out = self.do_apriltag(ilores, out)
-
-            okay, buf = cv2.imencode(".jpg", out)
-            if okay:
-                data = io.BytesIO(buf)
-                output.frame = data.getbuffer()
-                self.loop.call_soon_threadsafe(output.ready.set)
+            # SensorTimestamp is ns since boot, as time.monotonic_ns() is on Linux
+            t_sensor = meta.get('SensorTimestamp', int(t1 * 1e9))
+            stages.record('capture', t1 - t_sensor / 1e9)
+            ilores = arrays[-1]
+            imain = arrays[0] if len(arrays) == 2 else None
+            self.seq += 1
+            output.seq = self.seq
+            if self.seq == 1:
+                timeline.mark('first_frame')
+
+            # Detectors due this frame for the robot's mode, most important
+            # first so its results go out soonest.
+            out = imain
+            tags = ()
+            jobs = self.sched.due(NT.motor.get())
+            for job in jobs:
+                t = time.monotonic()
+                if job == 'ring':
+                    out = self.do_ring(imain, ilores)
+                else:
+                    tags = self.do_apriltag(ilores)
+                stages.record(job, time.monotonic() - t)
+
+            # results out first, before any drawing or encoding
+            ring = self.ring if 'ring' in jobs else None
+            box = ring and self.undistort_box(ring)
+            if self.udp:
+                self.udp.send(self.seq, t_sensor, tags, self.points, box, jobs, output.warm)
+            if detections.hub.clients:
+                self.handoff.result((self.seq, t1, args.cam, jobs,
+                    [(tag.getId(), tag.getDecisionMargin()) for tag in tags],
+                    self.points if tags else (), box))
+            self.latency += time.monotonic_ns() - t_sensor
+
+            if tags and 'first_tag' not in timeline.steps:
+                timeline.mark('first_tag')
+            self.tally()
+
+            # headless, nobody's watching: no drawing, no JPEG
+            (okay, buf) = (False, None)
+            if imain is not None:
+                # drawing only once both have seen the undrawn image
+                if self.ring and 'ring' in jobs:
+                    self.draw_ring(out)
+                if args.nodraw:
+                    self.draw_tags(tags, out)
+
+                okay, buf = cv2.imencode(".jpg", out)
+                if okay:
+                    data = io.BytesIO(buf)
+                    output.frame = data.getbuffer()
+                    output.latest = (self.seq, output.frame, ilores)
+                    output.shown = (self.seq, output.frame, out)
+                    self.handoff.frame()
+            if not output.warm:
+                self.set_ready()
+
+            if self.recorder:
+                self.recorder.record(self.seq, t0, ilores, buf if okay else None,
+                    tags, self.ring if 'ring' in jobs else None)
 
             x = NT.dist1.get()
             if x != self.dist1:
@@ -282,16 +708,86 @@ class Processor:
                 self.send('beam1', data=x)
 
             now = time.monotonic()
-            if now - base >= 2.5:
+            self.work += now - t1
+            if self.tuner:
+                self.tuner.update(now, now - t1, tags)
+            self.handoff.flush()
+
+            if now - base >= STATUS_PERIOD:
+                self.status(now - base)
                 base = now
-                print(f' t={now-t1:.3f}s t={now-t0:.3f}s')
 
         vlog.debug('exiting run')
 
 
-def run_vision(shutdown, sender, loop):
-    cam = Picamera2(args.cam)
-    vlog.debug('modes: %s', cam.sensor_modes)
+# Per-stage times, on the loop lag histogram's buckets so the two can be
+# read side by side: capture is sensor timestamp to the frame reaching us,
+# ring and tag are each detector's run.
+class Stages:
+    NAMES = ('capture', 'ring', 'tag')
+
+    def __init__(self):
+        self.counts = {x: [0] * (len(looplag.BUCKETS) + 1) for x in self.NAMES}
+        self.total = dict.fromkeys(self.NAMES, 0.0)
+        self.samples = dict.fromkeys(self.NAMES, 0)
+
+    def record(self, stage, secs):
+        secs = max(0.0, secs)
+        self.counts[stage][bisect.bisect_left(looplag.BUCKETS, secs)] += 1
+        self.total[stage] += secs
+        self.samples[stage] += 1
+
+    # Prometheus text format, for /metrics.
+    def metrics(self):
+        lines = [
+            '# HELP vision_stage_seconds Time per frame in each vision stage.',
+            '# TYPE vision_stage_seconds histogram',
+            ]
+        for stage in self.NAMES:
+            n = 0
+            for (le, count) in zip(looplag.BUCKETS, self.counts[stage]):
+                n += count
+                lines.append(f'vision_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines += [
+                f'vision_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {self.samples[stage]}',
+                f'vision_stage_seconds_sum{{stage="{stage}"}} {self.total[stage]:.6f}',
+                f'vision_stage_seconds_count{{stage="{stage}"}} {self.samples[stage]}',
+                ]
+        return '\n'.join(lines) + '\n'
+
+stages = Stages()
+
+
+def metrics():
+    return (output.handoff.metrics() if output.handoff else '') + stages.metrics()
+
+
+# For /status, the one page still served headless.
+def status():
+    return dict(cam=args.cam, warm=output.warm, seq=output.seq,
+        stalls=output.stalls, recoveries=output.recoveries, **current_config())
+
+
+# What to capture: an RGB main for drawing and the stream, and the YUV
+# lores for detection.  Headless, only the YUV, which on a camera is its
+# main stream (see cam_config()).
+def capture_names(cam):
+    if not args.headless:
+        return ['main', 'lores']
+    return ['lores'] if isinstance(cam, sources.Source) else ['main']
+
+
+def cam_config(cam):
+    if args.headless:
+        # no RGB at all, and the ISP only produces the one stream
+        cfg = cam.create_video_configuration(
+            controls=dict(FrameRate=args.fps),
+            main=dict(size=SIZE, format='YUV420'),
+        )
+        cfg['transform'] = libcamera.Transform(hflip=1, vflip=1)
+        vlog.debug('config: %s', cfg)
+        return cfg
+
     cfg = cam.create_video_configuration(
         controls=dict(
             FrameRate=args.fps,
@@ -307,28 +803,180 @@ def run_vision(shutdown, sender, loop):
     )
     cfg['transform'] = libcamera.Transform(hflip=1, vflip=1)
     # cam.set_controls(dict(FrameRate=120.0))
-    print(cfg)
-    cam.configure(cfg)
+    vlog.debug('config: %s', cfg)
+    return cfg
+
+
+def open_camera():
+    with timeline.step('camera'):
+        return new_camera()
+
+
+def new_camera():
+    global libcamera, Picamera2
+    if args.replay:
+        if args.stall:
+            return sources.StallingSource(args.replay, SIZE, fps=args.fps, every=args.stall)
+        return sources.ReplaySource(args.replay, SIZE, fps=args.fps)
+
+    import libcamera
+    from picamera2 import Picamera2
+    cam = Picamera2(args.cam)
+    if args.debug:
+        # sensor_modes tries each mode in turn, which takes a while
+        vlog.debug('modes: %s', cam.sensor_modes)
+    try:
+        cam.configure(cam_config(cam))
+    except Exception:
+        cam.close()
+        raise
 
     #cam2 = Picamera2(1)
     #cfg = cam2.create_video_configuration(main={"size": (1024, 768)})
     #cfg['transform'] = libcamera.Transform(vflip=1)
     #cam2.configure(cfg)
+    return cam
 
-    field = at.loadAprilTagLayoutField(at.AprilTagField.k2024Crescendo)
-    det = at.AprilTagDetector()
-    det.addFamily('tag36h11', bitsCorrected=0)
-    cfg = det.getConfig()
+
+def start_camera(cam, loop):
+    cam.start()
+    set_chroma(cam)
+    passthru.start(cam, loop, 'off' if args.headless else args.raw)
+
+
+# The lores colour space is picked by Picamera2 from the size: Smpte170m
+# (Rec601, limited) below 1280x720 and Rec709 from there up.  Sources
+# make theirs with OpenCV's I420, which is Rec601 limited too.
+def yuv_of(cam):
+    if isinstance(cam, sources.Source):
+        return ('Rec601', True)
+    space = cam.camera_configuration()['colour_space']
+    return (space.ycbcrEncoding.name, space.range.name == 'Limited')
+
+
+def set_chroma(cam=None):
+    global YUV, CHROMA_LOWER, CHROMA_UPPER
+    if cam:
+        YUV = yuv_of(cam)
+    (CHROMA_LOWER, CHROMA_UPPER) = chroma_bounds(LOWER, UPPER, YUV)
+
+
+def reopen_camera(loop):
+    cam = new_camera()
+    try:
+        start_camera(cam, loop)
+    except Exception:
+        close_camera(cam)
+        raise
+    return cam
+
+
+def close_camera(cam):
+    for step in (cam.stop_encoder, cam.stop, cam.close):
+        try:
+            step()
+        except Exception:
+            vlog.exception('%s failed', step.__name__)
+
+
+# Run fn in a thread of its own and give up on it after timeout seconds,
+# leaving it behind if it's stuck in the camera stack.  If it does finish
+# after that, cleanup() gets whatever it returned.  (Not an executor:
+# their threads hold up interpreter exit.)
+def bounded(timeout, fn, *args, cleanup=None):
+    result = []
+    lock = threading.Lock()
+    abandoned = False
+
+    def target():
+        try:
+            val = (True, fn(*args))
+        except Exception as ex:
+            val = (False, ex)
+        with lock:
+            if not abandoned:
+                result.append(val)
+                return
+        # we gave up on it, so nobody else will clean up what it made
+        if val[0] and cleanup:
+            vlog.warning('%s finished after we gave up, cleaning up', fn.__name__)
+            cleanup(val[1])
+
+    thread = threading.Thread(target=target, name=fn.__name__, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    with lock:
+        if not result:
+            abandoned = True
+            raise TimeoutError(f'{fn.__name__} still going after {timeout}s')
+    (okay, val) = result[0]
+    if not okay:
+        raise val
+    return val
+
+
+# Notices when frames stop coming, for any reason (a stall being
+# recovered, or something stuck we can't recover from), and keeps NT's
+# health topics up to date.
+async def watchdog():
+    loop = asyncio.get_running_loop()
+    (seq, since, health) = (None, loop.time(), None)
+    while True:
+        await asyncio.sleep(WATCH_PERIOD)
+        now = loop.time()
+        if output.seq != seq or not output.warm:
+            (seq, since) = (output.seq, now)
+        degraded = now - since > STALL_AFTER
+        if health and degraded != health[2]:
+            if degraded:
+                vlog.warning('no frame for %.1fs, degraded', now - since)
+            else:
+                vlog.info('frames flowing again')
+        if (output.stalls, output.recoveries, degraded) != health:
+            health = (output.stalls, output.recoveries, degraded)
+            NT.set_health(*health)
+
+
+def make_detector():
+    global at
+    with timeline.step('detector'):
+        import robotpy_apriltag as at
+        field = at.loadAprilTagLayoutField(at.AprilTagField.k2024Crescendo)
+        det = at.AprilTagDetector()
+        det.addFamily('tag36h11', bitsCorrected=0)
+        det.setConfig(base_config(det.getConfig()))
+    return det
+
+
+# Detector settings from the command line (or /ws), before any tuning.
+def base_config(cfg):
     cfg.quadDecimate = args.dec
     cfg.numThreads = args.threads
     cfg.decodeSharpening = 0.25 # margin jumps a lot with 1.0
     # cfg.quadSigma = 0.8
-    det.setConfig(cfg)
+    return cfg
 
+
+# Synthetic frames for Processor.warm_up(), run alongside open_camera()
+# and make_detector().  One noise frame is plenty for warming up, and the
+# full bank would make this the slowest step at startup.
+def make_scene():
+    from . import synth     # it imports us
+    with timeline.step('scene'):
+        return synth.Scene(SIZE, seed=int(time.time()), noise_bank=1)
+
+
+def prepare_calib():
+    with timeline.step('calib'):
+        CAL.prepare()
+
+
+def run_vision(shutdown, sender, loop, cam, det, scene):
     # global output1
     # output1 = StreamingOutput()
     # cam.start_recording(MJPEGEncoder(), FileOutput(output1))
-    cam.start()
+    with timeline.step('cam_start'):
+        start_camera(cam, loop)
 
     # global output2
     # output2 = StreamingOutput()
@@ -337,43 +985,163 @@ def run_vision(shutdown, sender, loop):
     # server = StreamingServer(address, StreamingHandler)
     # sw = asyncio.to_thread(server.serve_forever)
 
+    recorder = Recorder(args.record).start() if args.record else None
+    p = None
     try:
         p = Processor(shutdown, det, sender, loop)
+        with timeline.step('warmup'):
+            p.warm_up(scene)
+        p.recorder = recorder
+        if args.udp:
+            p.udp = Publisher(args.udp, cam=args.cam)
+        p.retune()
         p.run(cam)
     except Exception:
         traceback.print_exc()
     finally:
-        cam.stop()
-
-# Install mock function when not on host with the camera stuff installed.
-try:
-    libcamera
-except NameError:
-    def run_vision(shutdown, *_):
+        close_camera(p.cam if p and p.cam else cam)
+        if recorder:
+            recorder.stop()
+        if p and p.udp:
+            p.udp.close()
+
+# Install mock camera when not on host with the camera stuff installed.
+# A replay doesn't need the camera, so that still runs.
+if importlib.util.find_spec('picamera2') is None:
+    _open_camera = open_camera
+    def open_camera():
+        return _open_camera() if args.replay else None
+
+    _run_vision = run_vision
+    def run_vision(shutdown, sender, loop, cam, *rest):
+        if cam:
+            return _run_vision(shutdown, sender, loop, cam, *rest)
         while not shutdown.is_set():
             time.sleep(1)
 
 
+def geometry(size):
+    # Everything derived from the frame size.
+    cx = size[0] // 2
+    cy = size[1] // 2
+    cal = calib.load(args.calib, args.cam, size)
+    return size, int(size[0] * 0.05), cx, cy, cal
+
+
+def parse_res(res):
+    size = tuple(int(x) for x in res.split('x'))
+    if (len(size) != 2 or min(size) < 16 or size[0] > MAX_RES[0] or size[1] > MAX_RES[1]
+            or size[0] % 2 or size[1] % 2):    # YUV420 needs even sizes
+        raise ValueError(f'bad resolution {res!r}')
+    return size
+
+
+def current_config():
+    # the tuner changes these, so they're read back rather than from args
+    if output.det:
+        cfg = output.det.getConfig()
+        (dec, threads) = (cfg.quadDecimate, cfg.numThreads)
+    else:
+        (dec, threads) = (args.dec, args.threads)
+    return dict(
+        lower=LOWER.tolist(),
+        upper=UPPER.tolist(),
+        chroma_lower=list(CHROMA_LOWER),
+        chroma_upper=list(CHROMA_UPPER),
+        res=f'{SIZE[0]}x{SIZE[1]}',
+        fps=args.fps,
+        dec=dec,
+        threads=threads,
+        draw=args.nodraw,
+        headless=args.headless,
+        )
+
+
+# Validate changes (as sent in a /ws 'config' msg) and build everything
+# they depend on.  Runs in a worker thread, so the vision thread only has
+# to swap the results in.
+def prepare_config(changes):
+    update = dict(args={})
+    for key in ('lower', 'upper'):
+        if key in changes:
+            val = np.array(changes[key], dtype=LOWER.dtype)
+            if val.shape != (3,) or val.min() < 0 or val.max() > 255:
+                raise ValueError(f'bad {key} {changes[key]!r}')
+            update[key] = val
+    if 'lower' in update or 'upper' in update:
+        (lower, upper) = (update.get('lower', LOWER), update.get('upper', UPPER))
+        if (lower > upper).any():
+            raise ValueError(f'lower {lower.tolist()} above upper {upper.tolist()}')
+
+    if 'res' in changes:
+        size = parse_res(changes['res'])
+        if size != SIZE:
+            update['args']['res'] = changes['res']
+            update['geometry'] = geometry(size)
+            update['geometry'][4].prepare()
+
+    if 'fps' in changes:
+        fps = float(changes['fps'])
+        if not fps > 0:     # NaN too
+            raise ValueError(f'bad fps {changes["fps"]!r}')
+        update['args']['fps'] = fps
+
+    detector = {}
+    if 'dec' in changes:
+        detector['quadDecimate'] = update['args']['dec'] = max(1, int(changes['dec']))
+    if 'threads' in changes:
+        detector['numThreads'] = update['args']['threads'] = max(1, int(changes['threads']))
+    if detector:
+        update['detector'] = detector
+
+    if 'draw' in changes:
+        update['args']['nodraw'] = bool(changes['draw'])
+
+    if 'headless' in changes:
+        update['args']['headless'] = bool(changes['headless'])
+
+    unknown = set(changes) - {'lower', 'upper', 'res', 'fps', 'dec', 'threads', 'draw', 'headless'}
+    if unknown:
+        raise ValueError(f'unknown settings {sorted(unknown)}')
+
+    return update
+
+
+# Queues the changes for the vision thread, which sends the new config
+# once they're in.  False if nothing would change, so nothing will come.
+async def reconfigure(changes):
+    update = await asyncio.to_thread(prepare_config, changes)
+    if update['args'] or 'lower' in update or 'upper' in update:
+        output.pending.put(update)
+        return True
+    return False
+
+
 async def run(_args, sender):
     # Globals are a poor way to do this...
     global args
     args = _args
 
     # Globals are a poor way to do this...
-    global SIZE, MIN_SIZE
-    SIZE = tuple(int(x) for x in args.res.split('x'))
-    MIN_SIZE = int(SIZE[0] * 0.05)
-
-    # Globals are a poor way to do this...
-    global CX, CY, CAL
-    CX = SIZE[0] // 2
-    CY = SIZE[1] // 2
-    CAL = np.array([660, 0, CX, 0, 660, CY, 0, 0, 1], np.float32).reshape((3, 3))
+    global SIZE, MIN_SIZE, CX, CY, CAL
+    SIZE, MIN_SIZE, CX, CY, CAL = geometry(parse_res(args.res))
 
+    output.running = True
+    shutdown = threading.Event()
     try:
-        shutdown = threading.Event()
         loop = asyncio.get_running_loop()
-        await asyncio.to_thread(run_vision, shutdown, sender, loop)
+        # none waits on another, nor on NT or the web server
+        (cam, det, scene, _) = await asyncio.gather(
+            asyncio.to_thread(open_camera),
+            asyncio.to_thread(make_detector),
+            asyncio.to_thread(make_scene),
+            asyncio.to_thread(prepare_calib),
+            )
+        watch = asyncio.create_task(watchdog())
+        try:
+            await asyncio.to_thread(run_vision, shutdown, sender, loop, cam, det, scene)
+        finally:
+            watch.cancel()
     except asyncio.CancelledError:
         vlog.debug('cancelled')
     except Exception as ex:
@@ -3,16 +3,20 @@ import io
 import itertools
 import json
 import logging
+import mimetypes
 from pathlib import Path
 import weakref
 
 from aiohttp import web, http
 
-from . import vision
+from . import assets, detections, looplag, passthru, vision
+from .net_tables import NT
+from .startup import timeline
 from .utils import log_uncaught
 
 weblog = logging.getLogger('web')
 WEBDIR = Path(__file__).parent / 'web'
+manifest = assets.Manifest(WEBDIR)
 
 # middleware to turn off caching for things in the 'static' folder,
 # specifically those covered by the name='static' route, as opposed
@@ -25,7 +29,18 @@ async def cache_control(request: web.Request, handler):
         response.headers.setdefault('Cache-Control', 'no-cache')
     return response
 
-app = web.Application(middlewares=[cache_control])
+# Headless (--headless), only these are served, so the UI, streams and
+# snapshots cost nothing.  /detections is text, built only for
+# listeners.  POST /headless?on=0 brings the rest back.
+HEADLESS_PATHS = {'/metrics', '/status', '/headless', '/detections'}
+
+@web.middleware
+async def headless_gate(request, handler):
+    if vision.args.headless and request.path not in HEADLESS_PATHS:
+        raise web.HTTPServiceUnavailable(text='headless: POST /headless?on=0 for the UI')
+    return await handler(request)
+
+app = web.Application(middlewares=[headless_gate, cache_control])
 
 routes = web.RouteTableDef()
 #
@@ -117,16 +132,35 @@ class Client:
             self.send_task = asyncio.create_task(self.run_sending())
 
         self.send('meta', foo='bar', ver='0.1.1')
+        self.send('ready', cam=vision.args.cam, data=vision.output.warm)
 
         self.send_hash()
 
 
+    # Live settings change, e.g. {"_t": "config", "dec": 3, "lower": [...]}.
+    # With no settings, just reports the current ones.
+    def _msg_config(self, msg):
+        changes = {k: v for (k, v) in msg.items() if k != '_t'}
+        if changes:
+            asyncio.create_task(self.do_config(changes))
+        else:
+            self.send('config', **vision.current_config())
+
+
+    @log_uncaught
+    async def do_config(self, changes):
+        try:
+            if not await vision.reconfigure(changes):
+                self.send('config', **vision.current_config())
+        except (ValueError, TypeError) as ex:
+            self.log.warning('bad config %r: %s', changes, ex)
+            self.send('config', error=str(ex))
+
+
     def send_hash(self):
-        # Calculate and send hash of timestamps of sorted list of all files
-        # in the web folder, to let the UI know if files have changed.
-        import hashlib, struct
-        data = b''.join(struct.pack('L', int(x.stat().st_mtime)) for x in sorted(WEBDIR.glob('**/*')))
-        self.send('hash', data=hashlib.md5(data).hexdigest())
+        # Send the (cached) content hash of the web folder, to let the UI
+        # know if files have changed.
+        self.send('hash', data=manifest.hash)
 
 
     def send(self, msg, **kwargs):
@@ -159,14 +193,96 @@ async def close_all():
         await c.close()
 
 
+#-----------------------------
+
+@routes.get('/metrics')
+async def metrics(request):
+    return web.Response(text=(timeline.metrics() + NT.metrics() + vision.metrics()
+        + looplag.monitor.metrics() + detections.hub.metrics()), content_type='text/plain')
+
+@routes.get('/status')
+async def status(request):
+    return web.json_response(vision.status())
+
+# Turn headless on or off; applied between frames, so /status may not
+# show it straight away.
+@routes.post('/headless')
+async def headless(request):
+    on = request.query.get('on', '1') not in ('0', 'false')
+    await vision.reconfigure(dict(headless=on))
+    return web.json_response(dict(headless=on))
+
 #-----------------------------
 # The order is particular... for some reason the /ws has to come first,
 # then the /, and then the static routes.  I've tried variations but
 # so far this is the only one that works.  Need some digging to explain it.
 
+IMMUTABLE = 'public, max-age=31536000, immutable'
+mimetypes.add_type('font/woff2', '.woff2')     # missing before Python 3.12
+
+# Encodings the client will take, e.g. "gzip, deflate, br;q=0.5".
+def accepted(request):
+    found = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        (name, _, params) = item.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            found.add(name.strip().lower())
+    return found
+
+
+def asset_response(request, rel, blobs, etag, cache):
+    # Each encoding is a different body, so each gets its own tag.
+    ok = accepted(request)
+    enc = next((x for x in ('br', 'gzip') if x in blobs and x in ok), 'identity')
+    if enc != 'identity':
+        etag = f'{etag}-{enc}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache, 'Vary': 'Accept-Encoding'}
+    if any(x.value in (etag, '*') for x in request.if_none_match or ()):
+        raise web.HTTPNotModified(headers=headers)
+
+    (ctype, _) = mimetypes.guess_type(rel)
+    if enc != 'identity':
+        headers['Content-Encoding'] = enc
+    return web.Response(body=blobs[enc], headers=headers,
+        content_type=ctype or 'application/octet-stream')
+
+
+# Content-addressed assets.  index.html points its <base> here, so every
+# relative URL in the UI carries the manifest hash and can be cached
+# forever; a new hash means new URLs.  A stale hash (page loaded before an
+# edit) still gets the current file, just not cached.
+@routes.get('/v/{ver}/{path:.*}')
+async def versioned(request):
+    rel = request.match_info['path'] or 'index.html'
+    if rel not in manifest.files:
+        raise web.HTTPNotFound()
+
+    cache = IMMUTABLE if request.match_info['ver'] == manifest.hash else 'no-cache'
+    etag = manifest.files[rel]
+    if rel == 'index.html':
+        return await index(request)
+    if rel in manifest.blobs:
+        return asset_response(request, rel, manifest.blobs[rel], etag, cache)
+
+    # already compressed (images, fonts): straight from disk.  FileResponse
+    # guesses types from its own table, which doesn't know .woff2.
+    (ctype, _) = mimetypes.guess_type(rel)
+    return web.FileResponse(WEBDIR / rel, headers={'Cache-Control': cache,
+        'Content-Type': ctype or 'application/octet-stream'})
+
+
+# The page itself is never cached, but is small and points at the
+# versioned (cacheable) URLs for everything else.
+_index = (None, None)
+
 @routes.get('/')
 async def index(request):
-    return web.FileResponse(WEBDIR / 'index.html')
+    global _index
+    if _index[0] != manifest.hash:
+        html = manifest.blobs['index.html']['identity'].replace(b'<head>',
+            f'<head>\n    <base href="/v/{manifest.hash}/">'.encode(), 1)
+        _index = (manifest.hash, assets.compress(html))
+    return asset_response(request, 'index.html', _index[1], _index[0], 'no-cache')
     # raise web.HTTPFound('/web/index.html')
 
 routes.static('/', WEBDIR, show_index=True)
@@ -182,26 +298,46 @@ async def on_shutdown(app):
 
 app.on_shutdown.append(on_shutdown)
 
-app.add_routes(routes)
+# These have to go ahead of the static '/' route, which otherwise
+# swallows every path after it.
 app.add_routes([
     web.get('/stream1.mjpeg', vision.stream1),
+    web.get('/raw.mjpeg', passthru.stream),
+    web.get('/detections', detections.stream),
+    web.get(r'/snapshot{cam:\d*}.jpg', vision.snapshot_jpg),
+    web.get(r'/snapshot{cam:\d*}.npy', vision.snapshot_npy),
     ])
+app.add_routes(routes)
+
+
+# Tell connected UIs as soon as the web files change.
+def hash_changed(manifest):
+    send_all('hash', data=manifest.hash)
+
+manifest.listeners.append(hash_changed)
 
 
 class Web:
     def __init__(self):
         self.log = logging.getLogger('web')
+        self.watcher = None
 
     async def start(self, args):
-        self.runner = web.AppRunner(app)
-        await self.runner.setup()
-        site = web.TCPSite(self.runner, '', args.port)
-        await site.start()
+        with timeline.step('web'):
+            await asyncio.to_thread(manifest.build)
+            self.watcher = asyncio.create_task(manifest.watch())
+
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '', args.port)
+            await site.start()
 
         self.log.info(f'server started at http://:{args.port}')
 
 
     async def stop(self):
+        if self.watcher:
+            self.watcher.cancel()
         try:
             await self.runner.cleanup()
         except Exception:
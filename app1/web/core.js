@@ -27,6 +27,7 @@ export class Core {
         if (evt.msg == 'connected') {
             this.app.connected = this.connected = true;
             this.send('auth', {uuid: Core.client_uuid});
+            this.send('config');
         }
         else if (evt.msg == 'disconnected') {
             this.app.connected = this.connected = false;
@@ -111,6 +112,30 @@ export class Core {
         // console.log(`cam ${msg.cam} ${Math.round(fps, 1)} FPS`);
     }
 
+    _msg_config(msg) {
+        if (msg.error) {
+            console.error(`config: ${msg.error}`);
+        }
+        else {
+            this.app.config = msg;
+        }
+    }
+
+    _msg_ready(msg) {
+        // false until the vision pipeline has warmed up
+        this.app.cams[msg.cam].ready = msg.data;
+        this.app.requestUpdate('cams');
+    }
+
+    _msg_tune(msg) {
+        // no settings: the tuner's been turned off
+        this.app.cams[msg.cam].tune = 'dec' in msg ? msg : null;
+        this.app.requestUpdate('cams');
+        if (msg.reason) {
+            console.log(`cam ${msg.cam} tune: ${msg.reason} dec=${msg.dec} threads=${msg.threads} sharp=${msg.sharp}`);
+        }
+    }
+
     _msg_dist1(msg) {
         this.app.robot.dist1 = msg.data;
         this.app.requestUpdate('robot');
@@ -96,6 +96,7 @@ export class RmcApp extends LitElement {
         verwarn: {type: Boolean},
         cams: {state: true},
         robot: {state: true},
+        config: {state: true},
     };
 
     constructor() {
@@ -149,12 +150,17 @@ export class RmcApp extends LitElement {
                     : ''
                 }
                 <div class="meta">v${this.version}</div>
+                ${this.config
+                    ? html`<div class="meta">${this.config.res} @ ${this.config.fps} fps,
+                        dec ${this.config.dec}, ${this.config.threads} threads</div>`
+                    : ''
+                }
                 <slot></slot>
                 ${repeat(this.cams, (item) => item.num, (item) =>
                     html`<rmc-cam-view
                         num="${item.num}"
                         name="${item.name}"
-                        .data=${{fps: item.fps}}
+                        .data=${{fps: item.fps, tune: item.tune, ready: item.ready}}
                         @enabled=${this.camEnabled}
                         @snapshot=${this.camSnapshot}
                     ></rmc-cam-view>`
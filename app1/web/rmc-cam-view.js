@@ -39,6 +39,16 @@ const local = css`
 .name {
     color: blue;
 }
+
+.tune {
+    display: block;
+    color: gray;
+    font-size: 80%;
+}
+
+.warming {
+    color: orange;
+}
 `;
 
 export class RmcCamView extends LitElement {
@@ -118,6 +128,13 @@ export class RmcCamView extends LitElement {
                     @change=${this._enableChanged}
                 />
                 <span class="fps">${this.data.fps} FPS</span>
+                ${this.data.ready === false ? html`<span class="warming">warming up</span>` : ''}
+                ${this.data.tune
+                    ? html`<span class="tune" title=${this.data.tune.reason || ''}
+                        >dec ${this.data.tune.dec}, ${this.data.tune.threads} thr,
+                        sharp ${this.data.tune.sharp}, load ${this.data.tune.load}</span>`
+                    : ''
+                }
                 <div class="frame" @click=${this.snapshot}>
                     ${until(this.image, html`<img
                         src="img/no-cam.svg" width="100%" height="100%">`)}
@@ -408,28 +408,56 @@ class Processor:
         return imgout
 
 
+    # The CV work, in a worker thread so the loop keeps serving HTTP.
+    def process(self, imain, ilores):
+        out = self.do_frame(imain)
+        out = self.do_apriltag(ilores, out)
+        okay, buf = cv2.imencode(".jpg", out)
+        return buf if okay else None
+
+
+    # Wait for the camera's next completed request without blocking the
+    # loop: it calls back from its own thread when the frame is ready.
+    async def next_frame(self, cam, loop):
+        done = loop.create_future()
+        cam.capture_arrays(['main', 'lores'],
+            signal_function=lambda job: loop.call_soon_threadsafe(done.set_result, job))
+        return cam.wait(await done)
+
+
     async def run(self, cam):
+        loop = asyncio.get_running_loop()
         base = time.monotonic()
+        due = base
+        cpu = time.process_time()
         while core.running():
-            await asyncio.sleep(0.05)
+            if args.pace:
+                # slots on a fixed grid, so time spent on frames doesn't
+                # drift it, unless we fall a whole period behind
+                period = 1.0 / args.pace
+                now = time.monotonic()
+                if due > now:
+                    await asyncio.sleep(due - now)
+                due = max(due, now - period) + period
+
             # runs every 33ms with camera module v3 at 640x480 or 1024x768
             t0 = time.monotonic()
-            imain = cam.capture_array('main')
-            ilores = cam.capture_array('lores')
+            (imain, ilores), meta = await self.next_frame(cam, loop)
             t1 = time.monotonic()
-            out = self.do_frame(imain)
-            out = self.do_apriltag(ilores, out)
-
-            okay, buf = cv2.imencode(".jpg", out)
-            if okay:
+            buf = await asyncio.to_thread(self.process, imain, ilores)
+            if buf is not None:
                 data = io.BytesIO(buf)
                 output.frame = data.getbuffer()
                 output.ready.set()
 
             now = time.monotonic()
             if now - base >= 2.5:
+                # latency: sensor timestamp (ns since boot) to result
+                lat = time.monotonic_ns() - meta['SensorTimestamp']
+                print(f' t={now-t1:.3f}s t={now-t0:.3f}s lat={lat / 1e6:.1f}ms'
+                    f' cpu={(time.process_time() - cpu) / (now - base) * 100:.0f}%')
                 base = now
-                print(f' t={now-t1:.3f}s t={now-t0:.3f}s')
+                cpu = time.process_time()
 
         print('exiting run')
 
@@ -501,9 +529,8 @@ async def _run_vision():
 #-----------------------------
 
 class Core:
-    @property
     def running(self):
-        not self._shutdown.is_set()
+        return not self._shutdown.is_set()
 
     def shutdown(self):
         return self._shutdown.wait()
@@ -566,6 +593,7 @@ if __name__ == '__main__':
     parser.add_argument('--dec', type=int, default=2)
     parser.add_argument('--threads', type=int, default=4)
     parser.add_argument('--fps', type=float, default=60.0)
+    parser.add_argument('--pace', type=float, default=0.0) # process at most this many fps, 0=every frame
     parser.add_argument('--time', type=float, default=10.0)
     parser.add_argument('--team', type=int, default=8089)
 
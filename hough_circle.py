@@ -8,10 +8,12 @@ import logging
 import socketserver
 from http import server
 from threading import Condition
+import math
 import sys
 import time
 import traceback
 
+import ntcore
 import cv2
 import numpy as np
 
@@ -127,6 +129,30 @@ LOWER = np.array([100, 150, 100])
 UPPER = np.array([130, 255, 255])
 MIN_SIZE = int(IMG_SIZE[0] * 0.05)
 
+CAL = np.array([660, 0, CX, 0, 660, CY, 0, 0, 1], np.float32).reshape((3, 3))
+RING_DIAMETER = 0.356   # m, outer (14")
+CAM_HEIGHT = 0.50       # m, lens above the floor
+
+nt_ring_dist = None
+nt_ring_bearing = None
+
+
+# Ground distance (m) and bearing (degrees, right positive) to a ring, from
+# the ellipse it makes lying on the floor.  Seen from any angle the long
+# axis is the ring's full diameter, so it gives the range; the short axis
+# only shows how steeply we're looking down at it.
+def ring_geometry(ellipse):
+    (ex, ey), axes, _angle = ellipse
+    major = max(axes)
+    fx = CAL[0, 0]
+    # depth from the apparent size, then along the ray to the centre
+    ray = np.linalg.solve(CAL, [ex, ey, 1.0])
+    rng = fx * RING_DIAMETER / major * np.linalg.norm(ray)
+    dist = math.sqrt(max(rng ** 2 - CAM_HEIGHT ** 2, 0))
+    bearing = math.degrees(math.atan(ray[0]))
+    return dist, bearing
+
+
 def do_frame(iraw):
     ihsv = cv2.cvtColor(iraw, cv2.COLOR_RGB2HSV)
     # print(igray.shape) # 360,320 or 720,640
@@ -140,24 +166,9 @@ def do_frame(iraw):
     # Create a mask using the orange color range
     mask = cv2.inRange(frame, LOWER, UPPER)
 
-    circles = cv2.HoughCircles(mask, cv2.HOUGH_GRADIENT, dp=1, minDist=10,
-        param1=60, param2=20, minRadius=MIN_SIZE, maxRadius=IMG_SIZE[0])
-
-    if circles is not None:
-        # print(circles)
-        circles = list(circles[0])
-        # circles.sort(key=lambda x: x[2])
-        ncircles = len(circles)
-        best = circles[0]
-        # print(f'{ncircles} {best}      ', end='\r')
-        cx, cy, cr = best
-        # ctext = f'{cx!r},{cy!r},{cr!r}'
-        ctext = f'{cx:.0f},{cy:.0f},{cr:.0f}'
-    else:
-        ncircles = 0
-        ctext = 'none'
-
-    # Find contours in the mask
+    # Find contours in the mask.  HoughCircles over the whole mask cost
+    # most of the frame; fitting an ellipse to just the biggest contour
+    # gives the same geometry for a fraction of it.
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     # if contours:
     #     print(len(contours))
@@ -171,11 +182,25 @@ def do_frame(iraw):
 
         # Check if the detected object is big enough
         if maxdim >= MIN_SIZE:
-            matches.append((maxdim, box))
+            matches.append((maxdim, box, contour))
 
+    ellipse = None
     if matches:
-        matches.sort()
-        _, (x, y, w, h) = matches[-1]
+        matches.sort(key=lambda x: x[0])
+        _, (x, y, w, h), contour = matches[-1]
+
+        # the outline of a partly hidden ring still fits, as long as
+        # there are enough points (fitEllipse needs 5)
+        if len(contour) >= 5:
+            ellipse = cv2.fitEllipse(contour)
+        else:
+            (ex, ey), er = cv2.minEnclosingCircle(contour)
+            ellipse = ((ex, ey), (2 * er, 2 * er), 0)
+        dist, bearing = ring_geometry(ellipse)
+        ctext = f'{dist:.2f}m {bearing:+.1f}deg'
+        if nt_ring_dist:
+            nt_ring_dist.set(dist)
+            nt_ring_bearing.set(bearing)
 
         # outline the object
         imgout = cv2.rectangle(iraw, (x, y), (x+w, y+h), (0, 255, 0), 5)
@@ -186,16 +211,12 @@ def do_frame(iraw):
         iy = IMG_SIZE[1] - (y + h // 2)
 
         # Print the center coordinates of the circle
-        print(f"\rring: {ix:3d},{iy:3d} {ctext:10s}        ", end='')
+        print(f"\rring: {ix:3d},{iy:3d} {ctext:16s}        ", end='')
     else:
         imgout = iraw
 
-    if ncircles > 0:
-        try:
-            imgout = cv2.circle(imgout, (int(cx), int(cy)), int(cr), (255, 0, 40), 15)
-        except Exception as ex:
-            # print(ex)
-            pass
+    if ellipse:
+        imgout = cv2.ellipse(imgout, ellipse, (255, 0, 40), 5)
 
     okay, buf = cv2.imencode(".jpg", imgout)
     if okay:
@@ -222,6 +243,13 @@ async def process(cam):
 
 
 async def main():
+    global nt_ring_dist, nt_ring_bearing
+    nt = ntcore.NetworkTableInstance.getDefault()
+    nt.setServerTeam(8089)
+    nt.startClient4('hough_circle')
+    nt_ring_dist = nt.getDoubleTopic('/Vision/ring-dist').publish()
+    nt_ring_bearing = nt.getDoubleTopic('/Vision/ring-bearing').publish()
+
     cam1 = Picamera2(0)
     print(cam1.sensor_modes)
     cfg = cam1.create_video_configuration(controls=dict(